@@ -1,20 +1,190 @@
-from BERT import BERTModel
+from Cache import PredictionCache
 import numpy as np
+import os
+import threading
+import time
 
 class AI():
-    def __init__(self):
-        self.BERTModel = BERTModel('./models/MLTC_model_state.bin')
+    def __init__(self, model_path='./models/MLTC_model_state.bin', prediction_cache_path='./database/predictions.sqlite', prediction_cache_size=10000, quantize=False, num_threads=None, inference_server=None, token_cache_path='./database/tokens.sqlite'):
+        # The model is loaded on first use (or by warm_up), so that constructing AI does not import torch
+        # quantize=True runs the model with int8 linear layers on the CPU, see Benchmark.quantization for its accuracy
+        # inference_server, e.g. {'max_batch_size': 64, 'max_wait': 0.01}, runs the model in its own process
+        # and batches the predictions of concurrent requests together
+        self.model_path = model_path
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.inference_server = inference_server
+        self.token_cache_path = token_cache_path
+        self.BERTModel = None
+        self.model_status = 'not loaded'
+        self.model_error = None
+        # After a failed load the model is only loaded again once the retry delay has passed,
+        # the delay doubles with every failure up to max_retry_delay seconds
+        self.min_retry_delay = 5
+        self.max_retry_delay = 300
+        self.retry_delay = self.min_retry_delay
+        self.retry_at = None
+        self.model_lock = threading.Lock()
+        # The tokenizer of a model in this process cannot be used by two request threads at once
+        self.inference_lock = threading.Lock()
+        # Blocks never change, so the probabilities of a course are computed once and kept in memory and on disk
+        # The model file may only be provided later, nothing can be scored (or cached) before it exists anyway
+        model_stat = os.stat(model_path) if os.path.exists(model_path) else None
+        model_version = f"{model_stat.st_size}-{model_stat.st_mtime_ns}" if model_stat != None else "missing"
+        model_version += "-int8" if quantize else ""
+        self.prediction_cache = PredictionCache(prediction_cache_path, prediction_cache_size, model_version)
+
+    def check_model(self):
+        # A loaded model only stops working if its inference process died, it then counts as a failed load
+        # While the model is being loaded there is nothing to check yet
+        if self.model_lock.acquire(blocking=False):
+            try:
+                self.check_inference_server()
+            finally:
+                self.model_lock.release()
+        return self.model_status
+
+    def check_inference_server(self):
+        if self.inference_server != None and self.BERTModel != None and self.BERTModel.error != None:
+            error = self.BERTModel.error
+            self.BERTModel = None
+            self.model_failed(error)
+
+    def model_failed(self, error):
+        self.model_status = 'failed'
+        self.model_error = error
+        self.retry_at = time.monotonic() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, self.max_retry_delay)
+
+    def load_model(self, retry_now=False):
+        with self.model_lock:
+            self.check_inference_server()
+            if self.BERTModel == None:
+                if self.model_status == 'failed' and not retry_now and time.monotonic() < self.retry_at:
+                    raise RuntimeError(f"The model failed to load: {self.model_error}")
+                self.model_status = 'loading'
+                try:
+                    # Fail before the tokenizer and the base model are fetched for a model file that does not exist
+                    if not os.path.exists(self.model_path):
+                        raise FileNotFoundError(f"The model file {self.model_path} does not exist")
+                    if self.inference_server != None:
+                        from InferenceServer import InferenceServer
+                        self.BERTModel = InferenceServer(self.model_path, quantize=self.quantize, num_threads=self.num_threads, token_cache_path=self.token_cache_path, **self.inference_server)
+                    else:
+                        from BERT import BERTModel
+                        self.BERTModel = BERTModel(self.model_path, quantize=self.quantize, num_threads=self.num_threads, token_cache_path=self.token_cache_path)
+                except Exception as e:
+                    self.model_failed(str(e))
+                    raise
+                self.model_status = 'ready'
+                self.retry_delay = self.min_retry_delay
+        return self.BERTModel
+
+    def warm_up(self):
+        # Load the model in a background thread, model_status tells when it is ready
+        # An explicit warm up loads the model again right away, even if an earlier load failed
+        def load():
+            try:
+                self.load_model(retry_now=True)
+            except Exception as e:
+                print(e)
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def inference_metrics(self):
+        # Batching metrics of the inference server, None when the model runs in this process
+        model = self.BERTModel
+        if self.model_status != 'ready' or self.inference_server == None or model == None:
+            return None
+        return model.metrics()
+
+    def predict_probabilities(self, texts, wait_for_model=True):
+        # One row of 30 probabilities per text, only the texts missing from the cache are given to the model
+        # Without wait_for_model a model that is not ready yet raises instead of being waited for (or loaded)
+        rows = self.prediction_cache.get_many(texts)
+
+        missing_texts = list(dict.fromkeys(text for text, row in zip(texts, rows) if row is None))
+        if len(missing_texts) > 0:
+            if not wait_for_model and self.model_status != 'ready':
+                raise RuntimeError(f"The model is {self.model_status}")
+            model = self.load_model()
+            if self.inference_server == None:
+                with self.inference_lock:
+                    _, predictions_prob = model.get_predictions(missing_texts)
+            else:
+                # The inference server queues the requests of all threads itself
+                _, predictions_prob = model.get_predictions(missing_texts)
+            new_rows = {text: np.array(prob[0]) for text, prob in zip(missing_texts, predictions_prob)}
+            self.prediction_cache.put_many(missing_texts, new_rows.values())
+            rows = [new_rows[text] if row is None else row for text, row in zip(texts, rows)]
+
+        return np.array(rows)
     
     def ESG_scores_prediction(self, chain):
         if len(chain) == 1:
             return [[0, 0, 0]]
         BERT_input = self.extract_data(chain)
-        BERT_predictions, BERT_predictions_prob = self.BERTModel.get_predictions(BERT_input)
+        BERT_predictions_prob = self.predict_probabilities(BERT_input)
         
-        BERT_predictions_prob = np.array(BERT_predictions_prob)
         N = BERT_predictions_prob.shape[0]
+        normalized_prob = self.normalize_probabilities(BERT_predictions_prob)
+
+        # For each course, calculate its ESG scores
+        normalized_prob_each = normalized_prob.reshape((N, 3, 10))
+        each_ESG_scores = np.sum(normalized_prob_each, axis=2).tolist()
+        
+        # To calculate the total ESG scores,
+        # Sum the result element-wise by column (subtopic) 
+        sum_prob_subtopics = np.sum(normalized_prob, axis=0)
+        total_ESG_scores = self.total_ESG_scores(sum_prob_subtopics)
+        
+        return [total_ESG_scores] + each_ESG_scores
 
+    def ESG_scores_prediction_many(self, chains):
+        # ESG_scores_prediction for many chains at once, all courses are scored together and aggregated per chain
+        BERT_input = []
+        offsets = []
+        for chain in chains:
+            offsets.append(len(BERT_input))
+            BERT_input.extend(self.extract_data(chain))
+
+        BERT_predictions_prob = self.predict_probabilities(BERT_input) if len(BERT_input) > 0 else np.zeros((0, 30))
+        return self.ESG_scores_from_segments(BERT_predictions_prob, offsets)
+
+    def ESG_scores_from_segments(self, BERT_predictions_prob, offsets):
+        # The rows of chain i start at offsets[i] and end where the rows of the next chain start
+        N = BERT_predictions_prob.shape[0]
+        normalized_prob = self.normalize_probabilities(BERT_predictions_prob)
+        each_ESG_scores = np.sum(normalized_prob.reshape((N, 3, 10)), axis=2).tolist()
+        total_ESG_scores = self.total_ESG_scores_from_segments(normalized_prob, offsets).tolist()
+
+        ends = list(offsets[1:]) + [N]
+        all_ESG_scores = []
+        for i in range(len(offsets)):
+            if offsets[i] == ends[i]:
+                all_ESG_scores.append([[0, 0, 0]])
+            else:
+                all_ESG_scores.append([total_ESG_scores[i]] + each_ESG_scores[offsets[i]:ends[i]])
+        return all_ESG_scores
+
+    def total_ESG_scores_from_segments(self, normalized_prob, offsets):
+        # Sum the subtopics of every chain in one segmented reduction, then sum to E, S, G and cap at 1
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(np.append(offsets, normalized_prob.shape[0]))
+
+        sum_prob_subtopics = np.zeros((len(offsets), 30))
+        # reduceat cannot express an empty segment, but skipping them leaves every other segment unchanged
+        nonempty = lengths > 0
+        if np.any(nonempty):
+            sum_prob_subtopics[nonempty] = np.add.reduceat(normalized_prob, offsets[nonempty], axis=0)
+
+        total_ESG_scores = np.sum(sum_prob_subtopics.reshape((-1, 3, 10)), axis=2)
+        total_ESG_scores[total_ESG_scores > 1] = 1
+        return total_ESG_scores
+
+    def normalize_probabilities(self, BERT_predictions_prob):
         # Remove the probabilities that are < 0.5 (classification threshold)
+        BERT_predictions_prob = BERT_predictions_prob.copy()
         BERT_predictions_prob[BERT_predictions_prob < 0.5] = 0
 
         # Normalize the result by ([probabilities which are > 0.5] - 0.5) / 0.5, ignoring 0s
@@ -23,24 +193,41 @@ class AI():
         normalized_prob[nonzero_indices] = (BERT_predictions_prob[nonzero_indices] - 0.5) / 0.5
 
         # Add weight = 0.1 (each subtopic is 1/10 of E, S, or G)
-        normalized_prob = normalized_prob * 0.1
+        return normalized_prob * 0.1
 
-        # For each course, calculate its ESG scores
-        normalized_prob_each = normalized_prob.reshape((N, 3, 10))
-        each_ESG_scores = np.sum(normalized_prob_each, axis=2).tolist()
-        
-        # To calculate the total ESG scores,
-        # Sum the result element-wise by column (subtopic) 
-        sum_prob_subtopics = np.sum(normalized_prob, axis=0)
-        
+    def total_ESG_scores(self, sum_prob_subtopics):
         # Reshape the result to (3, 10) and sum it element-wise by row to get the total score of each E, S, and G, cap maximum at 1
         sum_prob_subtopics = sum_prob_subtopics.reshape((3, 10))
         total_ESG_scores = np.sum(sum_prob_subtopics, axis=1)
         total_ESG_scores[total_ESG_scores > 1] = 1
-        total_ESG_scores = total_ESG_scores.tolist()
-        
-        return [total_ESG_scores] + each_ESG_scores
-    
+        return total_ESG_scores.tolist()
+
+    def update_ESG_tally(self, tally, chain, wait_for_model=True):
+        # Score only the blocks mined since the tally was last updated
+        # The model runs outside of the lock of the tally, so reading the tally never waits for the model to load,
+        # if another thread added the same blocks meanwhile they are scored again from the cache
+        while True:
+            with tally.lock:
+                scored_blocks = tally.scored_blocks
+            if scored_blocks >= len(chain):
+                return tally
+            # extract_data skips the first block it is given, which here is the last block already scored
+            BERT_input = self.extract_data(chain[scored_blocks - 1:])
+            normalized_prob = self.normalize_probabilities(self.predict_probabilities(BERT_input, wait_for_model))
+            with tally.lock:
+                if tally.scored_blocks == scored_blocks:
+                    tally.add(normalized_prob)
+                    return tally
+
+    def ESG_scores_from_tally(self, tally, from_index=1, limit=None):
+        # The same [total] + each structure as ESG_scores_prediction,
+        # optionally with only the scores of up to limit blocks from the block from_index on
+        with tally.lock:
+            if len(tally.each_ESG_scores) == 0:
+                return [[0, 0, 0]]
+            end = None if limit == None else from_index - 1 + max(limit, 0)
+            return [self.total_ESG_scores(tally.sum_prob_subtopics)] + tally.each_ESG_scores[from_index - 1:end]
+
     def extract_data(self, chain):
         chain = chain[1:]
         all_combined = []
@@ -49,6 +236,19 @@ class AI():
             all_combined.append(combined)
 
         return all_combined
-    
 
 
+class ESGTally():
+    # Running ESG scores of one chain, so that reading them does not depend on the length of the chain
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The genesis block has no course to score
+        self.scored_blocks = 1
+        self.sum_prob_subtopics = np.zeros(30)
+        self.each_ESG_scores = []
+
+    def add(self, normalized_prob):
+        # Add the normalized probabilities of the next courses of the chain, the sum per subtopic is kept uncapped
+        self.sum_prob_subtopics += np.sum(normalized_prob, axis=0)
+        self.each_ESG_scores += np.sum(normalized_prob.reshape((-1, 3, 10)), axis=2).tolist()
+        self.scored_blocks += normalized_prob.shape[0]
@@ -1,5 +1,6 @@
 import torch
 from transformers import BertTokenizer, BertModel
+from Cache import TokenCache
 
 
 class BERTClass(torch.nn.Module):
@@ -20,43 +21,82 @@ class BERTClass(torch.nn.Module):
         return output
     
 class BERTModel():
-    def __init__(self, trained_model_path):
-        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    def __init__(self, trained_model_path, batch_size=32, quantize=False, num_threads=None, token_cache_path=None, token_cache_size=100000):
+        if num_threads != None:
+            torch.set_num_threads(num_threads)
+        # Dynamically quantized models only run on the CPU
+        self.device = torch.device('cuda') if torch.cuda.is_available() and not quantize else torch.device('cpu')
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
         self.model = BERTClass()
-        self.model.load_state_dict(torch.load(trained_model_path))
+        self.model.load_state_dict(torch.load(trained_model_path, map_location=self.device))
         self.model = self.model.to(self.device)
         self.model = self.model.eval()
+        if quantize:
+            # Store the weights of all linear layers (BERT and the 768 -> 30 head) as int8,
+            # activations are quantized on the fly
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.batch_size = batch_size
+        # Token ids per text, shared by every chain and kept on disk if a path is given
+        self.token_cache = TokenCache(token_cache_path, token_cache_size, 'bert-base-uncased-256')
 
-    def get_predictions(self, input):
-        all_predictions = []
-        all_predictions_prob = []
+    def tokenize(self, input):
+        # The token ids of each text, only the texts missing from the token cache go through the tokenizer
+        all_input_ids = self.token_cache.get_many(input)
 
-        for raw_text in input:
-            encoded_text = self.tokenizer.encode_plus(
-                raw_text,
-                None,
+        missing_texts = list(dict.fromkeys(text for text, input_ids in zip(input, all_input_ids) if input_ids is None))
+        if len(missing_texts) > 0:
+            encoded_texts = self.tokenizer(
+                missing_texts,
                 add_special_tokens=True,
                 max_length=256,
-                padding='max_length',
-                return_token_type_ids=True,
-                truncation=True,
-                return_attention_mask=True,
-                return_tensors='pt'
+                truncation=True
             )
+            self.token_cache.put_many(missing_texts, encoded_texts['input_ids'])
+            new_input_ids = dict(zip(missing_texts, encoded_texts['input_ids']))
+            all_input_ids = [new_input_ids[text] if input_ids is None else input_ids for text, input_ids in zip(input, all_input_ids)]
 
-            input_ids = encoded_text['input_ids'].to(self.device)
-            attention_mask = encoded_text['attention_mask'].to(self.device)
-            token_type_ids = encoded_text['token_type_ids'].to(self.device)
+        return all_input_ids
 
-            output = self.model(input_ids, attention_mask, token_type_ids)
+    def get_predictions(self, input, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        all_predictions = [None] * len(input)
+        all_predictions_prob = [None] * len(input)
+        if len(input) == 0:
+            return all_predictions, all_predictions_prob
 
-            # add sigmoid, for the training sigmoid is in BCEWithLogitsLoss
-            predictions_prob = torch.sigmoid(output).detach().cpu()
-            # thresholding at 0.5
-            predictions = predictions_prob.flatten().round()
+        all_input_ids = self.tokenize(input)
 
-            all_predictions.append(predictions.tolist())
-            all_predictions_prob.append(predictions_prob.tolist())
+        # Sort the texts by token length so that each batch is only padded to the longest of similar lengths
+        order = sorted(range(len(input)), key=lambda i: len(all_input_ids[i]))
 
-        return all_predictions, all_predictions_prob
\ No newline at end of file
+        with torch.inference_mode():
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                # A single sequence has token type 0 and is fully attended before padding
+                encoded_batch = self.tokenizer.pad(
+                    {
+                        'input_ids': [all_input_ids[i] for i in batch],
+                        'token_type_ids': [[0] * len(all_input_ids[i]) for i in batch],
+                        'attention_mask': [[1] * len(all_input_ids[i]) for i in batch]
+                    },
+                    padding='longest',
+                    return_tensors='pt'
+                )
+
+                input_ids = encoded_batch['input_ids'].to(self.device)
+                attention_mask = encoded_batch['attention_mask'].to(self.device)
+                token_type_ids = encoded_batch['token_type_ids'].to(self.device)
+
+                output = self.model(input_ids, attention_mask, token_type_ids)
+
+                # add sigmoid, for the training sigmoid is in BCEWithLogitsLoss
+                predictions_prob = torch.sigmoid(output).cpu()
+                # thresholding at 0.5
+                predictions = predictions_prob.round()
+
+                # Put the results back in the order of the input, each probability row keeps its (1, 30) shape
+                for row, i in enumerate(batch):
+                    all_predictions[i] = predictions[row].tolist()
+                    all_predictions_prob[i] = predictions_prob[row:row + 1].tolist()
+
+        return all_predictions, all_predictions_prob
\ No newline at end of file
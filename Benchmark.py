@@ -0,0 +1,279 @@
+import sys
+import time
+import os
+import csv
+import io
+import tracemalloc
+import json
+import tempfile
+import threading
+import random
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from Blockchain import Block, Blockchain, BlockchainEncoder, BlockchainDecoder, get_parallel_miner
+from BlockchainStorage import BlockchainStorage
+
+
+class Benchmark:
+    def mining(self, difficulty=5, blocks=5):
+        # Hashes per second of the serial miner and of the parallel miner with 2, 4, ... up to all cores
+        all_workers = [1]
+        while all_workers[-1] * 2 <= os.cpu_count():
+            all_workers.append(all_workers[-1] * 2)
+        if all_workers[-1] != os.cpu_count():
+            all_workers.append(os.cpu_count())
+
+        for workers in all_workers:
+            attempts = 0
+            start = time.perf_counter()
+            for i in range(blocks):
+                block = Block(i, '2024-04-30 00:00:00', {'course_title': str(i)}, "0"*64)
+                block.calculate_hash_with_proof(difficulty, workers)
+                attempts += block.nonce + 1 if workers == 1 else get_parallel_miner(workers).last_attempts
+            elapsed = time.perf_counter() - start
+
+            print(f"workers: {workers:3d}  attempts: {attempts:10d}  time: {elapsed:8.2f}s  hashes/s: {attempts / elapsed:12.0f}")
+
+    def load_courses(self, with_labels=False):
+        # The course texts in the same "title. description" form that AI.extract_data gives to the model
+        with open('./models/courses.csv', 'r', encoding='utf-8') as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        courses = [row['title'] + '. ' + row['description'] for row in rows]
+        if with_labels:
+            labels = [[int(row[key]) for key in row if key not in ('link', 'title', 'description')] for row in rows]
+            return courses, labels
+        return courses
+
+    def reference_predictions(self, model, texts):
+        # The original per-course path: every course padded to 256 tokens and run through the model on its own
+        import torch
+
+        all_predictions_prob = []
+        with torch.inference_mode():
+            for raw_text in texts:
+                encoded_text = model.tokenizer(
+                    raw_text,
+                    add_special_tokens=True,
+                    max_length=256,
+                    padding='max_length',
+                    return_token_type_ids=True,
+                    truncation=True,
+                    return_attention_mask=True,
+                    return_tensors='pt'
+                )
+
+                input_ids = encoded_text['input_ids'].to(model.device)
+                attention_mask = encoded_text['attention_mask'].to(model.device)
+                token_type_ids = encoded_text['token_type_ids'].to(model.device)
+
+                output = model.model(input_ids, attention_mask, token_type_ids)
+                all_predictions_prob.append(torch.sigmoid(output).cpu().tolist())
+
+        return all_predictions_prob
+
+    def inference(self, max_courses=512, batch_size=32):
+        # Courses per second of the original per-course path padded to 256 tokens against the dynamically padded
+        # path with one course and with mini-batches, for 1, 2, 4, ... courses
+        from BERT import BERTModel
+
+        # No token cache, so that every path tokenizes every course like the reference does
+        model = BERTModel('./models/MLTC_model_state.bin', token_cache_size=0)
+        courses = self.load_courses()
+
+        n = 1
+        while n <= max_courses:
+            texts = [courses[i % len(courses)] for i in range(n)]
+
+            start = time.perf_counter()
+            reference_prob = self.reference_predictions(model, texts)
+            reference_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            _, single_prob = model.get_predictions(texts, 1)
+            single_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            _, batch_prob = model.get_predictions(texts, batch_size)
+            batch_elapsed = time.perf_counter() - start
+
+            max_difference = max(abs(a - b) for x, y in zip(reference_prob + reference_prob, single_prob + batch_prob)
+                                 for a, b in zip(x[0], y[0]))
+            print(f"courses: {n:4d}  reference: {n / reference_elapsed:8.1f}/s  single: {n / single_elapsed:8.1f}/s  "
+                  f"batch: {n / batch_elapsed:8.1f}/s  max difference to reference: {max_difference:.2e}")
+            n *= 2
+
+    def quantization(self, num_threads=0):
+        # Label flips at the 0.5 threshold, latency and size of the int8 model against the fp32 model
+        import torch
+        from BERT import BERTModel
+
+        courses, labels = self.load_courses(with_labels=True)
+        results = {}
+        for name, quantize in (('fp32', False), ('int8', True)):
+            model = BERTModel('./models/MLTC_model_state.bin', quantize=quantize, num_threads=num_threads or None)
+            model.get_predictions(courses[:8])
+
+            start = time.perf_counter()
+            predictions, _ = model.get_predictions(courses)
+            elapsed = time.perf_counter() - start
+
+            state = io.BytesIO()
+            torch.save(model.model.state_dict(), state)
+            correct = sum(int(p) == l for prediction, label in zip(predictions, labels) for p, l in zip(prediction, label))
+
+            results[name] = predictions
+            print(f"{name}  latency: {elapsed / len(courses) * 1000:8.2f} ms/course  size: {state.tell() / 2**20:8.1f} MiB  "
+                  f"label accuracy: {correct / (len(courses) * 30):.4f}")
+
+        flips = [sum(a != b for a, b in zip(x, y)) for x, y in zip(results['fp32'], results['int8'])]
+        print(f"labels flipped: {sum(flips)} of {len(courses) * 30}, in {sum(flip > 0 for flip in flips)} of {len(courses)} courses")
+
+    def memory(self, blocks=1000000):
+        # Memory per block of a chain held as plain objects with string fields (the old Block) and as compact Blocks
+        class PlainBlock:
+            def __init__(self, index, timestamp, data, previous_hash, nonce=0, hash=None):
+                self.index = index
+                self.timestamp = timestamp
+                self.data = data
+                self.previous_hash = previous_hash
+                self.nonce = nonce
+                self.hash = hash
+
+        courses = self.load_courses()
+        for name, block_class in (('plain', PlainBlock), ('compact', Block)):
+            tracemalloc.start()
+            chain = []
+            previous_hash = "0"*64
+            for i in range(blocks):
+                # Fresh strings for every block, as json.load gives them
+                title, description = courses[i % len(courses)].split('. ', 1)
+                data = {
+                    'course_title': title,
+                    'course_description': description,
+                    'transaction_hash': '0x' + sha256(b'%d' % i).hexdigest()
+                }
+                hash = sha256(b'%d' % -i).hexdigest()
+                chain.append(block_class(i, f"2024-04-30 {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}", data, previous_hash, i * 7, hash))
+                previous_hash = hash
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f"{name:8s} blocks: {blocks}  memory: {size / 2**20:9.1f} MiB  per block: {size / blocks:7.1f} bytes")
+            del chain
+
+    def loading(self, chains=10000, blocks=20):
+        # Startup time of a generated database with the decoder hooks, the streaming loader and the lazy index
+        courses = self.load_courses()
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = os.path.join(directory, 'chains.json')
+            log_path = os.path.join(directory, 'chains.log')
+            all_chains = []
+            for c in range(chains):
+                blockchain = Blockchain('0x' + sha256(b'%d' % c).hexdigest()[:40])
+                for i in range(blocks):
+                    title, description = courses[(c + i) % len(courses)].split('. ', 1)
+                    data = {'course_title': title, 'course_description': description} if i > 0 else "Genesis Block"
+                    blockchain.chain.append(Block(i, '2024-04-30 00:00:00', data, "0"*64, i, sha256(b'%d' % i).hexdigest()))
+                all_chains.append(blockchain)
+            with open(snapshot_path, 'w') as json_file:
+                json.dump(all_chains, json_file, cls=BlockchainEncoder)
+            size = os.path.getsize(snapshot_path)
+            del all_chains
+
+            start = time.perf_counter()
+            with open(snapshot_path, 'r') as json_file:
+                json.load(json_file, cls=BlockchainDecoder)
+            print(f"decoder  chains: {chains}  size: {size / 2**20:8.1f} MiB  time: {time.perf_counter() - start:8.2f}s")
+
+            start = time.perf_counter()
+            BlockchainStorage(snapshot_path, log_path).load()
+            print(f"stream   chains: {chains}  size: {size / 2**20:8.1f} MiB  time: {time.perf_counter() - start:8.2f}s")
+
+            start = time.perf_counter()
+            lazy_chains = BlockchainStorage(snapshot_path, log_path).load(lazy=True)
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            lazy_chains.get('0x' + sha256(b'0').hexdigest()[:40])
+            print(f"lazy     chains: {chains}  size: {size / 2**20:8.1f} MiB  time: {elapsed:8.2f}s  first lookup: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    def stress(self, wallets=10, blocks=10, threads=32):
+        # Create, mine and read chains from many threads at once through the HTTP API of a BlockchainAPI
+        # on an empty database, then check that every chain has all its blocks, is valid and loads back the same
+        # Half of the blocks are mined through /mine_block, the other half directly on top of the same chains
+        from werkzeug.serving import make_server
+        from BlockchainAPI import BlockchainAPI
+        from BlockchainClient import BlockchainClient
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            # Without a model, so that neither the reads nor the scoring of the mined blocks depend on it
+            os.makedirs(os.path.join(directory, 'database'))
+            os.chdir(directory)
+            try:
+                api = BlockchainAPI('127.0.0.1', 0, mining_threads=threads)
+                # Compact whenever the log outgrows the snapshot, so compactions run while blocks are appended
+                api.storage.compaction_threshold = 0
+                api.register_routes()
+                server = make_server('127.0.0.1', 0, api.app, threaded=True)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                client = BlockchainClient('127.0.0.1', server.server_port, timeout=600, pool_size=threads)
+
+                ids = ['0x' + sha256(b'%d' % w).hexdigest()[:40] for w in range(wallets)]
+                tasks = [('create', id, None) for id in ids for _ in range(3)]
+                tasks += [('mine', id, f"{id}-{i}") for id in ids for i in range(blocks)]
+                tasks += [('read', id, None) for id in ids for _ in range(blocks)]
+                random.seed(0)
+                random.shuffle(tasks)
+                # Chains must exist before blocks are mined on them
+                tasks.sort(key=lambda task: task[0] != 'create')
+
+                def run_task(task):
+                    operation, id, transaction_hash = task
+                    if operation == 'create':
+                        return client.create_chain(id)
+                    if operation == 'read':
+                        # Without the scores, so that the reads test the chains and not the model
+                        return client.concurrently((client.get_chain, id, -5), (client.get_profile, id, -5, 5, ['chain', 'valid']), (client.check_valid, id))
+                    data = {'course_title': 'Stress', 'course_description': 'Stress test block', 'transaction_hash': transaction_hash}
+                    if int(transaction_hash.rsplit('-', 1)[1]) % 2 == 0:
+                        return api.mine_block_now(id, data)
+                    return client.mine_block(id, data['course_title'], data['course_description'], transaction_hash)
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(threads) as executor:
+                    creates = [executor.submit(run_task, task) for task in tasks if task[0] == 'create']
+                    for future in creates:
+                        future.result()
+                    results = list(executor.map(run_task, [task for task in tasks if task[0] != 'create']))
+                for result in results:
+                    if isinstance(result, dict) and 'job_id' in result:
+                        api.mining_scheduler.wait(result['job_id'])
+                elapsed = time.perf_counter() - start
+                print(f"wallets: {wallets}  blocks: {wallets * blocks}  requests: {len(tasks)}  threads: {threads}  time: {elapsed:8.2f}s")
+
+                server.shutdown()
+                api.storage.close()
+                for id in ids:
+                    blockchain = api.find_chain_by_id(id)
+                    transaction_hashes = sorted(block.data['transaction_hash'] for block in blockchain.chain[1:])
+                    assert transaction_hashes == sorted(f"{id}-{i}" for i in range(blocks)), f"{id} lost or duplicated blocks"
+                    assert blockchain.is_chain_valid(full=True) and blockchain.find_invalid_block(0, 4) == None, f"{id} is not valid"
+
+                reloaded = BlockchainStorage('./database/chains.json', './database/chains.log').load()
+                assert json.dumps(reloaded, cls=BlockchainEncoder) == json.dumps(api.all_chains, cls=BlockchainEncoder), "the database differs from memory"
+                print(f"all {len(ids)} chains are complete and valid, the database on disk matches memory")
+            finally:
+                os.chdir(cwd)
+
+    def run(self, name, args):
+        getattr(self, name)(*[int(arg) for arg in args])
+
+
+if __name__ == '__main__':
+    # e.g. python Benchmark.py mining [difficulty] [blocks]
+    #      python Benchmark.py inference [max courses] [batch size]
+    #      python Benchmark.py quantization [threads]
+    #      python Benchmark.py memory [blocks]
+    #      python Benchmark.py loading [chains] [blocks per chain]
+    #      python Benchmark.py stress [wallets] [blocks per wallet] [threads]
+    Benchmark().run(sys.argv[1], sys.argv[2:])
@@ -1,65 +1,397 @@
 from hashlib import sha256
-from datetime import datetime
+from datetime import datetime, timedelta
 from json import JSONEncoder, JSONDecoder
+import multiprocessing
+import threading
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+EPOCH = datetime(1970, 1, 1)
+# Fields of the block data whose values repeat across wallets (every buyer of a collection gets the same course)
+INTERNED_FIELDS = ('course_title', 'course_description')
+
+
+def compact_timestamp(timestamp):
+    # A 'YYYY-mm-dd HH:MM:SS' timestamp as integer seconds since the epoch, anything else is kept as it is
+    # The wall-clock time is counted as if it were UTC, so converting back gives the same string in any time zone
+    if isinstance(timestamp, str) and len(timestamp) == 19 and timestamp[4] + timestamp[7] + timestamp[10] + timestamp[13] + timestamp[16] == '-- ::':
+        days = epoch_days(timestamp[:10])
+        clock = timestamp[11:13] + timestamp[14:16] + timestamp[17:19]
+        if days != None and clock.isascii() and clock.isdigit():
+            hours, minutes, seconds = int(clock[0:2]), int(clock[2:4]), int(clock[4:6])
+            if hours < 24 and minutes < 60 and seconds < 60:
+                return days * 86400 + hours * 3600 + minutes * 60 + seconds
+    return timestamp
+
+
+# Days since the epoch per 'YYYY-mm-dd' date, a database spans few distinct dates so loading parses each only once
+_epoch_days = {}
+
+
+def epoch_days(date):
+    if date not in _epoch_days:
+        days = None
+        digits = date[0:4] + date[5:7] + date[8:10]
+        if digits.isascii() and digits.isdigit():
+            try:
+                days = (datetime(int(date[0:4]), int(date[5:7]), int(date[8:10])) - EPOCH).days
+            except ValueError:
+                pass
+        _epoch_days[date] = days
+    return _epoch_days[date]
+
+
+# 'YYYY-mm-dd' per days since the epoch, the inverse of _epoch_days, and the clock strings of every minute and second,
+# so that expanding a timestamp (e.g. to hash its block) does not go through datetime
+_epoch_dates = {}
+_clock_minutes = [f" {minute // 60:02d}:{minute % 60:02d}:" for minute in range(1440)]
+_clock_seconds = [f"{second:02d}" for second in range(60)]
+
+
+def expand_timestamp(timestamp):
+    if isinstance(timestamp, int):
+        days, seconds = divmod(timestamp, 86400)
+        if days not in _epoch_dates:
+            moment = EPOCH + timedelta(days=days)
+            _epoch_dates[days] = f"{moment.year:04d}-{moment.month:02d}-{moment.day:02d}"
+        minutes, seconds = divmod(seconds, 60)
+        return _epoch_dates[days] + _clock_minutes[minutes] + _clock_seconds[seconds]
+    return timestamp
+
+
+def compact_hash(hash):
+    # A lowercase 64-digit hex hash as its 32 raw bytes, anything else (e.g. None before mining) is kept as it is
+    if isinstance(hash, str) and len(hash) == 64:
+        try:
+            raw = bytes.fromhex(hash)
+            if raw.hex() == hash:
+                return raw
+        except ValueError:
+            pass
+    return hash
+
+
+def expand_hash(hash):
+    if isinstance(hash, bytes):
+        return hash.hex()
+    return hash
+
+
+def compact_data(data):
+    # Share the strings of repeated course texts and of the keys between all blocks, keeping the key order
+    if isinstance(data, dict):
+        return {sys.intern(key) if isinstance(key, str) else key: sys.intern(value) if key in INTERNED_FIELDS and isinstance(value, str) else value for key, value in data.items()}
+    return data
 
 
 class Block:
+    # Blocks are stored compactly (no __dict__, raw hashes, integer timestamps, interned course texts),
+    # the properties give back the original strings, so hashes and JSON are the same as before
+    __slots__ = ('index', '_timestamp', 'data', '_previous_hash', 'nonce', '_hash')
+
     def __init__(self, index, timestamp, data, previous_hash, nonce=0, hash=None):
         self.index = index
         self.timestamp = timestamp
-        self.data = data
+        self.data = compact_data(data)
         self.previous_hash = previous_hash
         self.nonce = nonce
         self.hash = hash
 
+    @property
+    def timestamp(self):
+        return expand_timestamp(self._timestamp)
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = compact_timestamp(timestamp)
+
+    @property
+    def previous_hash(self):
+        return expand_hash(self._previous_hash)
+
+    @previous_hash.setter
+    def previous_hash(self, previous_hash):
+        self._previous_hash = compact_hash(previous_hash)
+
+    @property
+    def hash(self):
+        return expand_hash(self._hash)
+
+    @hash.setter
+    def hash(self, hash):
+        self._hash = compact_hash(hash)
+
+    def hash_prefix(self):
+        # The bytes hashed before the nonce, they stay the same during the proof of work search
+        # Encoding the joined strings once gives the same bytes as encoding each of them
+        return (
+            str(self.index) +
+            str(expand_timestamp(self._timestamp)) +
+            str(self.data) +
+            str(expand_hash(self._previous_hash))
+        ).encode('utf-8')
+
     def calculate_hash(self):
         return sha256(
-            str(self.index).encode('utf-8') +
-            str(self.timestamp).encode('utf-8') +
-            str(self.data).encode('utf-8') +
-            str(self.previous_hash).encode('utf-8') +
+            self.hash_prefix() +
             str(self.nonce).encode('utf-8')
         ).hexdigest()
 
-    def calculate_hash_with_proof(self, difficulty=4):
-        while True:
-            hash_value = self.calculate_hash()
+    def has_valid_hash(self):
+        # Compare the raw digest with the stored hash, it is only expanded to hex if it is not stored compactly
+        digest = sha256(self.hash_prefix() + str(self.nonce).encode('utf-8'))
+        if isinstance(self._hash, bytes):
+            return self._hash == digest.digest()
+        return self._hash == digest.hexdigest()
+
+    def calculate_hash_with_proof(self, difficulty=4, workers=1, processes=0):
+        # workers > 1 splits the search for this block across that many processes,
+        # processes > 0 searches in one process of a shared pool, so blocks of other chains are mined alongside it
+        if workers > 1:
+            return get_parallel_miner(workers).mine(self, difficulty)
+        if processes > 0:
+            self.nonce = get_mining_pool(processes).submit(_mine_nonce, self.hash_prefix(), difficulty, self.nonce).result()
+            return self.calculate_hash()
+
+        self.nonce, _ = find_nonce(self.hash_prefix(), difficulty, self.nonce)
+        return self.calculate_hash()
+
+
+# How many nonces are tried per batch, the stop signal of parallel mining is checked between batches
+MINING_BATCH_SIZE = 1000
+
+
+def find_nonce(prefix, difficulty, start, step=1, stop=None):
+    # Search the nonces start, start + step, start + 2 * step, ... for a hash with `difficulty` leading hex zeros
+    # and return the nonce (None if stopped) with the number of attempts
+    if difficulty <= 0:
+        return start, 1
+
+    # The prefix is hashed once and its state copied for every nonce, and instead of formatting the digest
+    # as hex it is compared as bytes with 2 ** (256 - 4 * difficulty), the smallest digest that is too large
+    prefix_state = sha256(prefix)
+    target = (1 << (256 - 4 * difficulty)).to_bytes(32, 'big')
+    batch_start = start
+    attempts = 0
+    while stop == None or not stop.is_set():
+        for nonce in range(batch_start, batch_start + MINING_BATCH_SIZE * step, step):
+            nonce_state = prefix_state.copy()
+            nonce_state.update(b'%d' % nonce)
+            if nonce_state.digest() < target:
+                return nonce, attempts + (nonce - batch_start) // step + 1
+
+        batch_start += MINING_BATCH_SIZE * step
+        attempts += MINING_BATCH_SIZE
+    return None, attempts
+
+
+_found = None
+
 
-            if hash_value[:difficulty] == "0" * difficulty:
-                return hash_value
+def _init_mining_worker(found):
+    global _found
+    _found = found
 
-            self.nonce += 1
+
+def _search_nonces(prefix, difficulty, start, step):
+    nonce, attempts = find_nonce(prefix, difficulty, start, step, _found)
+    if nonce != None:
+        _found.set()
+    return nonce, attempts
+
+
+class ParallelMiner:
+    def __init__(self, workers):
+        self.workers = workers
+        # The pool is started lazily from a threaded server, a forked process could inherit a lock held by another thread
+        context = multiprocessing.get_context('spawn')
+        self.found = context.Event()
+        self.pool = context.Pool(workers, initializer=_init_mining_worker, initargs=(self.found,))
+        # The stop signal is shared by all workers of the pool, so only one block is mined at a time
+        self.lock = threading.Lock()
+        self.last_attempts = 0
+
+    def mine(self, block, difficulty=4):
+        # Interleave the nonce space across the workers, the first valid hash stops all of them
+        with self.lock:
+            self.found.clear()
+            prefix = block.hash_prefix()
+            tasks = [(prefix, difficulty, block.nonce + k, self.workers) for k in range(self.workers)]
+            results = self.pool.starmap(_search_nonces, tasks)
+
+        self.last_attempts = sum(attempts for _, attempts in results)
+        block.nonce = min(nonce for nonce, _ in results if nonce != None)
+        return block.calculate_hash()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+_parallel_miners = {}
+_parallel_miners_lock = threading.Lock()
+_mining_pools = {}
+
+
+def _mine_nonce(prefix, difficulty, start):
+    nonce, _ = find_nonce(prefix, difficulty, start)
+    return nonce
+
+
+def get_mining_pool(processes):
+    # Processes that each mine a whole block, started once per process count and reused for every block
+    with _parallel_miners_lock:
+        if processes not in _mining_pools:
+            _mining_pools[processes] = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+        return _mining_pools[processes]
+
+
+def get_parallel_miner(workers):
+    # Worker processes are started once per worker count and reused for every block
+    with _parallel_miners_lock:
+        if workers not in _parallel_miners:
+            _parallel_miners[workers] = ParallelMiner(workers)
+        return _parallel_miners[workers]
     
 
 class Blockchain:
     def __init__(self, id):
         self.id = id
         self.chain = []
+        # Highest index already verified and the hash it had, later checks only verify the blocks after it
+        self.verified_index = 0
+        self.verified_hash = None
+        # Held from reading the tip to appending the new block, so two blocks mined at once cannot fork the chain,
+        # chains of different ids are mined concurrently (in parallel only with processes, see calculate_hash_with_proof)
+        self.lock = threading.Lock()
 
-    def add_block(self, data):
-        new_block = Block(
-            index=len(self.chain),
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            data=data,
-            previous_hash=self.chain[-1].hash if data != "Genesis Block" else "0"*64
-        )
-        new_block.hash = new_block.calculate_hash_with_proof()
+    def __getstate__(self):
+        # Locks cannot be pickled (e.g. to send a chain to another process), the copy gets a new one
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
 
-        self.chain.append(new_block)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
-    def is_chain_valid(self):
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
+    def add_block(self, data, workers=1, persist=None, processes=0):
+        # Return the new block, by the time it returns other threads may have appended more blocks
+        # persist(block) is called with the chain still locked, so the blocks of a chain are persisted in order
+        with self.lock:
+            new_block = Block(
+                index=len(self.chain),
+                timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                data=data,
+                previous_hash=self.chain[-1].hash if data != "Genesis Block" else "0"*64
+            )
+            new_block.hash = new_block.calculate_hash_with_proof(workers=workers, processes=processes)
+
+            self.chain.append(new_block)
+            if persist != None:
+                persist(new_block)
+        return new_block
 
-            print(current_block.hash, current_block.calculate_hash())
-            if current_block.hash != current_block.calculate_hash():
-                return False
-            if current_block.previous_hash != previous_block.hash:
-                return False
+    def is_chain_valid(self, full=False):
+        # The height is read once, blocks mined meanwhile are only marked as verified by a later check
+        height = len(self.chain)
+        start = 1
+        if not full and self.verified_index < height and self.chain[self.verified_index].hash == self.verified_hash:
+            start = self.verified_index + 1
 
+        if self.find_invalid_block(start, end=height) != None:
+            # Whatever was verified before can no longer be trusted
+            self.verified_index = 0
+            self.verified_hash = None
+            return False
+
+        if height > 0:
+            self.verified_index = height - 1
+            self.verified_hash = self.chain[height - 1].hash
         return True
 
+    def find_invalid_block(self, start=1, difficulty=None, end=None):
+        # Return the index of the first block from start (up to end) with a wrong hash or link to the previous block,
+        # or without the proof of work if a difficulty is given, None if all of them are valid
+        end = len(self.chain) if end == None else end
+        for i in range(start, end):
+            current_block = self.chain[i]
+
+            if current_block.index != i or not current_block.has_valid_hash():
+                return i
+            # Both hashes are compacted the same way, so the raw values are equal exactly when the hex strings are
+            if i > 0 and current_block._previous_hash != self.chain[i-1]._hash:
+                return i
+            if difficulty != None and current_block.hash[:difficulty] != "0" * difficulty:
+                return i
+
+        return None
+
+
+def normalize_id(id):
+    # Ethereum addresses are case-insensitive, the mixed case is only an EIP-55 checksum
+    if isinstance(id, str) and len(id) == 42 and id[:2].lower() == '0x':
+        return id.lower()
+    return id
+
+
+class ChainRegistry:
+    def __init__(self, chains=()):
+        self.chains = {}
+        # Chains are created from any request thread
+        self.create_lock = threading.Lock()
+        for blockchain in chains:
+            self.add(blockchain)
+
+    def __len__(self):
+        return len(self.chains)
+
+    def __iter__(self):
+        # Over a copy, so that chains created meanwhile (e.g. during a compaction) do not break the iteration
+        return iter(list(self.chains.values()))
+
+    def __contains__(self, id):
+        return normalize_id(id) in self.chains
+
+    def add(self, blockchain):
+        self.chains[normalize_id(blockchain.id)] = blockchain
+
+    def get(self, id):
+        return self.chains.get(normalize_id(id))
+
+    def get_or_create(self, id, workers=1, persist=None, processes=0):
+        # Return the chain of the id, creating it with its genesis block if it does not exist yet
+        # persist(block) is called with the genesis block of a created chain, before any other block can be added to it
+        blockchain = self.get(id)
+        if blockchain != None:
+            return blockchain, False
+
+        # The genesis block is mined outside of the lock, if another thread created the chain meanwhile that one is kept
+        new_blockchain = Blockchain(id)
+        new_blockchain.add_block("Genesis Block", workers, processes=processes)
+        with self.create_lock:
+            blockchain = self.get(id)
+            if blockchain != None:
+                return blockchain, False
+            # Other threads find the chain as soon as it is added, but wait for its lock to add blocks to it
+            with new_blockchain.lock:
+                self.add(new_blockchain)
+                if persist != None:
+                    persist(new_blockchain.chain[0])
+        return new_blockchain, True
+
+
+def block_from_dict(dct):
+    # Build a block straight from its parsed JSON object, without a decoder hook on every nested dict
+    return Block(dct['index'], dct['timestamp'], dct['data'], dct['previous_hash'], dct['nonce'], dct['hash'])
+
+
+def blockchain_from_dict(dct):
+    blockchain = Blockchain(dct['id'])
+    blockchain.chain = [block_from_dict(block) for block in dct['chain']]
+    return blockchain
+
 
 class BlockEncoder(JSONEncoder):
     def default(self, obj):
@@ -98,6 +430,8 @@ class BlockchainEncoder(JSONEncoder):
                 'id': obj.id,
                 'chain': obj.chain
             }
+        elif isinstance(obj, ChainRegistry):
+            return list(obj)
         elif isinstance(obj, Block):
             return BlockEncoder().default(obj)
 
@@ -124,4 +458,4 @@ class BlockchainDecoder(JSONDecoder):
             else:
                 decoded_block = block
             decoded_blocks.append(decoded_block)
-        return decoded_blocks
\ No newline at end of file
+        return decoded_blocks
\ No newline at end of file
@@ -1,50 +1,103 @@
-from flask import Flask, request, jsonify
-import json
-from Blockchain import Blockchain, BlockchainEncoder, BlockchainDecoder
-from AI import AI
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from Blockchain import Block, Blockchain, BlockchainEncoder, normalize_id
+from BlockchainStorage import BlockchainStorage
+from MiningScheduler import MiningScheduler
+from ChainAuditor import ChainAuditor
+from concurrent.futures import ThreadPoolExecutor
+from AI import AI, ESGTally
+from Cache import ChainJSONCache
+
+
+class BlockchainJSONProvider(DefaultJSONProvider):
+    # Lets jsonify serialize blocks and chains directly, in the same form as BlockchainEncoder
+    def __init__(self, app):
+        super().__init__(app)
+        self.encoder = BlockchainEncoder()
+
+    def default(self, obj):
+        if isinstance(obj, (Block, Blockchain)):
+            return self.encoder.default(obj)
+        return super().default(obj)
 
 
 class BlockchainAPI:
-    def __init__(self, host, port):
+    def __init__(self, host, port, mining_workers=1, mining_threads=4, inference_server=None, lazy_load=False, mining_processes=0):
         self.host = host
         self.port = port
+        # Number of processes searching for the proof of work of a block, 1 mines in the mining thread
+        self.mining_workers = mining_workers
+        # Blocks of one chain are mined in order, up to mining_threads chains are mined concurrently
+        # The proof of work of mining threads shares the GIL, and the processes of mining_workers > 1 mine one block
+        # at a time, so chains are only mined in parallel by mining_processes > 0 processes that each mine a whole block
+        self.mining_processes = mining_processes
+        self.mining_scheduler = MiningScheduler(self.mine_block_now, mining_threads)
         self.app = Flask(__name__)
+        self.app.json = BlockchainJSONProvider(self.app)
+        # Serialized blocks per chain, get_chain only serializes the blocks mined since the last call
+        self.chain_json = ChainJSONCache(self.compact_json)
+        self.storage = BlockchainStorage('./database/chains.json', './database/chains.log')
+        # With lazy_load a chain is only parsed from the JSON file the first time it is used
+        self.lazy_load = lazy_load
         self.all_chains = self.load_all_chains()
-        self.AI = AI()
+        # Chain operations are served right away while the model loads in the background
+        self.AI = AI(inference_server=inference_server)
+        self.AI.warm_up()
+        # Running ESG scores per chain, brought up to date in the background whenever a block is mined
+        self.ESG_tallies = {}
+        self.scoring_executor = ThreadPoolExecutor(max_workers=1)
+
+    def compact_json(self, obj):
+        # The separators jsonify uses outside of debug mode
+        return self.app.json.dumps(obj, separators=(',', ':'))
 
     def load_all_chains(self):
-        # Load the object back from the JSON file
-        loaded_chains = []
+        # Load the last snapshot of the JSON file and replay the block log on top of it
+        return self.storage.load(lazy=self.lazy_load)
+
+    def dump_all_chains(self, wait=True):
+        # Dump the object to a JSON file, this also empties the block log
         try:
-            with open('./database/chains.json', 'r') as json_file:
-                loaded_chains = json.load(json_file, cls=BlockchainDecoder)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
+            self.storage.compact(self.all_chains, wait)
+        except IOError as e:
             print(e)
-        return loaded_chains
 
-    def dump_all_chains(self):
-        # Dump the object to a JSON file
+    def block_persister(self, id, queued):
+        # The persist callback of add_block and get_or_create, it queues the record of the block while the chain
+        # is locked and leaves waiting for it (in wait_for_blocks) to after the chain is unlocked
+        return lambda block: queued.append(self.storage.queue_block(id, block))
+
+    def wait_for_blocks(self, queued):
+        # Only the new blocks are appended to the block log, they are on disk when this returns
         try:
-            with open('./database/chains.json', 'w') as json_file:
-                json.dump(self.all_chains, json_file, cls=BlockchainEncoder)
+            for request in queued:
+                self.storage.wait(request)
         except IOError as e:
             print(e)
 
+        # The storage writer compacts in the background, the block does not wait for it
+        if self.storage.should_compact():
+            self.dump_all_chains(wait=False)
+
     def find_chain_by_id(self, id):
-        for chain in self.all_chains:
-            if chain.id == id:
-                return chain
-        return None
+        return self.all_chains.get(id)
+
+    def get_ESG_tally(self, blockchain):
+        return self.ESG_tallies.setdefault(normalize_id(blockchain.id), ESGTally())
+
+    def update_ESG_scores(self, blockchain):
+        try:
+            self.AI.update_ESG_tally(self.get_ESG_tally(blockchain), blockchain.chain)
+        except Exception as e:
+            print(e)
 
     def create_chain(self):
         id = request.args.get('id')
-        blockchain = self.find_chain_by_id(id)
+        queued = []
+        blockchain, created = self.all_chains.get_or_create(id, self.mining_workers, self.block_persister(id, queued), self.mining_processes)
         
-        if blockchain == None:
-            blockchain = Blockchain(id)
-            blockchain.add_block("Genesis Block")
-
-            self.all_chains.append(blockchain)
+        if created:
+            self.wait_for_blocks(queued)
 
             response = {
                 'message': 'A chain is CREATED',
@@ -55,11 +108,19 @@ class BlockchainAPI:
                 'message': 'The chain already EXISTS',
                 'id': blockchain.id
             }
-
-        self.dump_all_chains()
         
         return jsonify(response), 200
 
+    def mine_block_now(self, id, data):
+        blockchain = self.find_chain_by_id(id)
+        queued = []
+        block = blockchain.add_block(data, self.mining_workers, self.block_persister(blockchain.id, queued), self.mining_processes)
+        self.wait_for_blocks(queued)
+        # While the model cannot be loaded the tally is not updated, the next update scores the skipped blocks too
+        if self.AI.check_model() != 'failed':
+            self.scoring_executor.submit(self.update_ESG_scores, blockchain)
+        return block
+
     def mine_block(self):
         id = request.args.get('id')
         data = {
@@ -69,67 +130,287 @@ class BlockchainAPI:
         }
 
         blockchain = self.find_chain_by_id(id)
-        blockchain.add_block(data)
+        if blockchain == None:
+            response = {
+                'message': 'The chain does NOT EXIST',
+                'id': id
+            }
+            return jsonify(response), 404
+
+        job_id = self.mining_scheduler.submit(blockchain.id, data)
+
+        # Mining runs in the background, wait=true keeps the old behaviour of answering with the mined block
+        if request.args.get('wait', 'false').lower() == 'true':
+            job = self.mining_scheduler.wait(job_id)
+            if job == None:
+                # Only if so many jobs finished since it was submitted that it was already pruned
+                response = {
+                    'message': 'The job does NOT EXIST',
+                    'job_id': job_id
+                }
+                return jsonify(response), 404
+            response = {
+                'message': 'A block is MINED' if job['status'] == 'mined' else 'The block is NOT MINED',
+                'id': blockchain.id,
+                'job_id': job_id,
+                'block': blockchain.chain[job['index']] if job['status'] == 'mined' else None
+            }
+        else:
+            response = {
+                'message': 'A block is QUEUED',
+                'id': blockchain.id,
+                'job_id': job_id
+            }
+        
+        return jsonify(response), 200
+
+    def mine_status(self):
+        job_id = request.args.get('job_id')
+        job = self.mining_scheduler.status(job_id)
+        if job == None:
+            response = {
+                'message': 'The job does NOT EXIST',
+                'job_id': job_id
+            }
+            return jsonify(response), 404
 
         response = {
-            'message': 'A block is MINED',
-            'id': blockchain.id,
-            'block': blockchain.chain[-1]
+            'job_id': job_id,
+            'id': job['id'],
+            'status': job['status'],
+            'pending': self.mining_scheduler.pending_count(job['id'])
         }
+        if job['status'] == 'mined':
+            response['index'] = job['index']
+            response['hash'] = job['hash']
+        elif job['status'] == 'failed':
+            response['error'] = job['error']
 
-        self.dump_all_chains()
-
-        response = json.loads(json.dumps(response, cls=BlockchainEncoder))
-        
         return jsonify(response), 200
 
+    def chain_range(self, height, from_index=None, limit=None):
+        # The indices [from_index, to_index) of up to limit blocks of a chain of the height,
+        # a negative from_index is counted from the tip, e.g. -10 for the last 10 blocks
+        if from_index == None:
+            from_index = 0
+        elif from_index < 0:
+            from_index = max(height + from_index, 0)
+
+        from_index = min(from_index, height)
+        to_index = height if limit == None else min(from_index + max(limit, 0), height)
+        return from_index, to_index
+
     def get_chain(self):
         id = request.args.get('id')
         blockchain = self.find_chain_by_id(id)
+        if blockchain == None:
+            response = {
+                'message': 'The chain does NOT EXIST',
+                'id': id
+            }
+            return jsonify(response), 404
+
+        # Blocks are only appended, so the blocks up to this height do not change while they are served
+        height = len(blockchain.chain)
+        tip_hash = blockchain.chain[height - 1].hash if height > 0 else None
+
+        # head=true answers with the height and the tip hash only, e.g. to check whether a chain grew
+        if request.args.get('head', 'false').lower() == 'true':
+            response = {
+                'id': blockchain.id,
+                'height': height,
+                'tip_hash': tip_hash
+            }
+            return jsonify(response), 200
+
+        from_index = request.args.get('from_index', type=int)
+        limit = request.args.get('limit', type=int)
+        since_hash = request.args.get('since_hash')
+
+        if from_index == None and limit == None and since_hash == None:
+            # The same body as jsonify({'id': ..., 'chain': ...}) gives, with the keys sorted, around the cached blocks
+            body = b'{"chain":' + self.chain_json.get(normalize_id(blockchain.id), blockchain.chain) + b',"id":' + self.compact_json(blockchain.id).encode('utf-8') + b'}\n'
+            return Response(body, mimetype=self.app.json.mimetype), 200
+
+        if since_hash != None:
+            # The blocks after the one with the hash, searched from the tip since it is usually a recent block
+            from_index = next((i + 1 for i in range(height - 1, -1, -1) if blockchain.chain[i].hash == since_hash), None)
+            if from_index == None:
+                response = {
+                    'message': 'The hash is NOT IN the chain',
+                    'id': blockchain.id,
+                    'since_hash': since_hash
+                }
+                return jsonify(response), 404
+
+        from_index, to_index = self.chain_range(height, from_index, limit)
 
         response = {
             'id': blockchain.id,
-            'chain': blockchain.chain
+            'chain': blockchain.chain[from_index:to_index],
+            'from_index': from_index,
+            'height': height,
+            'tip_hash': tip_hash
         }
 
-        response = json.loads(json.dumps(response, cls=BlockchainEncoder))
-
         return jsonify(response), 200
     
     def get_prediction(self):
         id = request.args.get('id')
+        # The scores of the blocks from from_index on (1 is the first course) after the total, up to limit of them,
+        # a negative from_index counts from the tip as in get_chain
+        from_index = request.args.get('from_index', 1, type=int)
+        limit = request.args.get('limit', type=int)
         blockchain = self.find_chain_by_id(id)
+        if blockchain == None:
+            response = {
+                'message': 'The chain does NOT EXIST',
+                'id': id
+            }
+            return jsonify(response), 404
+
+        # Usually a read of the running scores, only blocks not scored yet (e.g. after a restart) hit the model
+        tally = self.AI.update_ESG_tally(self.get_ESG_tally(blockchain), blockchain.chain)
+        if from_index < 0:
+            from_index = tally.scored_blocks + from_index
+        from_index = max(from_index, 1)
 
         response = {
             'id': blockchain.id,
-            'ESG scores': self.AI.ESG_scores_prediction(blockchain.chain),
+            'ESG scores': self.AI.ESG_scores_from_tally(tally, from_index, limit),
         }
+        if from_index != 1 or limit != None:
+            response['from_index'] = from_index
         
         return jsonify(response), 200
 
     def check_valid(self):
         id = request.args.get('id')
+        # Only the blocks mined since the last check are verified, full=true re-verifies the whole chain
+        full = request.args.get('full', 'false').lower() == 'true'
         blockchain = self.find_chain_by_id(id)
+        if blockchain == None:
+            response = {
+                'message': 'The chain does NOT EXIST',
+                'id': id
+            }
+            return jsonify(response), 404
 
         response = {
-            'message': 'The chain is VALID' if blockchain.is_chain_valid() else 'The chain is NOT VALID',
+            'message': 'The chain is VALID' if blockchain.is_chain_valid(full) else 'The chain is NOT VALID',
         }
         
         return jsonify(response), 200
 
-    def run_server(self):
+    def profile(self):
+        # Chain, ESG scores and validity of a chain in one answer, the chain is looked up once and
+        # the blocks and the scores are of the same range of it
+        # fields selects some of chain, scores and valid, e.g. fields=scores,valid
+        id = request.args.get('id')
+        fields = request.args.get('fields', 'chain,scores,valid').split(',')
+        full = request.args.get('full', 'false').lower() == 'true'
+        blockchain = self.find_chain_by_id(id)
+        if blockchain == None:
+            response = {
+                'message': 'The chain does NOT EXIST',
+                'id': id
+            }
+            return jsonify(response), 404
+
+        height = len(blockchain.chain)
+        from_index, to_index = self.chain_range(height, request.args.get('from_index', type=int), request.args.get('limit', type=int))
+
+        response = {
+            'id': blockchain.id,
+            'height': height,
+            'tip_hash': blockchain.chain[height - 1].hash if height > 0 else None,
+            'from_index': from_index
+        }
+        # A caller that already has the profile of this height and tip (if_height and if_tip_hash) only gets told so
+        if request.args.get('if_height', type=int) == height and request.args.get('if_tip_hash') == response['tip_hash']:
+            response['modified'] = False
+            return jsonify(response), 200
+        if 'chain' in fields:
+            response['chain'] = blockchain.chain[from_index:to_index]
+        if 'scores' in fields:
+            # The total, then the scores of the blocks of the range, the genesis block has none
+            # Without the model (or while it loads) the rest of the profile is still answered right away,
+            # with the model status instead of scores
+            try:
+                tally = self.AI.update_ESG_tally(self.get_ESG_tally(blockchain), blockchain.chain, wait_for_model=False)
+                scores_from_index = max(from_index, 1)
+                response['ESG scores'] = self.AI.ESG_scores_from_tally(tally, scores_from_index, to_index - scores_from_index)
+            except Exception as e:
+                print(e)
+                response['ESG scores'] = None
+                response['model'] = self.AI.model_status
+        if 'valid' in fields:
+            response['valid'] = 'The chain is VALID' if blockchain.is_chain_valid(full) else 'The chain is NOT VALID'
+
+        return jsonify(response), 200
+
+    def check_all(self):
+        # Stream one JSON line per chain while the chains are verified across processes, then a summary line
+        workers = request.args.get('workers', type=int)
+        difficulty = request.args.get('difficulty', 4, type=int)
+        auditor = ChainAuditor(workers, difficulty)
+
+        return Response(stream_with_context(auditor.stream(list(self.all_chains))), mimetype='application/x-ndjson')
+
+    def health(self):
+        # The server is serving chain operations as soon as it answers, ESG predictions need the model to be ready
+        self.AI.check_model()
+        response = {
+            'status': 'serving',
+            'model': self.AI.model_status
+        }
+        if self.AI.model_status == 'failed':
+            response['model_error'] = self.AI.model_error
+        if self.AI.inference_metrics() != None:
+            response['inference'] = self.AI.inference_metrics()
+
+        return jsonify(response), 200
+
+    def register_routes(self):
         self.app.route('/create_chain', methods=['GET'])(self.create_chain)
         self.app.route('/mine_block', methods=['GET'])(self.mine_block)
+        self.app.route('/mine_status', methods=['GET'])(self.mine_status)
         self.app.route('/get_chain', methods=['GET'])(self.get_chain)
         self.app.route('/get_prediction', methods=['GET'])(self.get_prediction)
         self.app.route('/check_valid', methods=['GET'])(self.check_valid)
+        self.app.route('/profile', methods=['GET'])(self.profile)
+        self.app.route('/check_all', methods=['GET'])(self.check_all)
+        self.app.route('/health', methods=['GET'])(self.health)
+
+    def run_server(self):
+        # Flask's development server, create_app is the entry point for a production server
+        self.register_routes()
+        self.app.run(host=self.host, port=self.port, threaded=True)
+
 
-        self.app.run(host=self.host, port=self.port)
+def create_app(mining_workers=1, mining_threads=4, inference_server=None, lazy_load=False, mining_processes=0):
+    # App factory for a production WSGI server, e.g.
+    #   gunicorn -w 1 --threads 16 -b 127.0.0.1:5000 'BlockchainAPI:create_app()'
+    # The chains live in the memory of one process and are appended to one log, so the server runs a single
+    # worker process with many threads (a second one fails on ./database/chains.lock), the CPU-heavy work
+    # (mining with mining_workers > 1 or mining_processes > 0, the model with an inference_server, audits)
+    # runs in processes of its own
+    api = BlockchainAPI(None, None, mining_workers, mining_threads, inference_server, lazy_load, mining_processes)
+    api.register_routes()
+    return api.app
 
 
 if __name__ == '__main__':
     host = "127.0.0.1"
     port = 5000
+    mining_workers = 1
+    mining_threads = 4
+    # e.g. 4 to mine the blocks of up to 4 chains in parallel, each in a process of its own
+    mining_processes = 0
+    # e.g. {'max_batch_size': 64, 'max_wait': 0.01} to run BERT in a separate inference process
+    inference_server = None
+    # True to parse the chains of a large database on first use instead of at startup
+    lazy_load = False
 
-    api = BlockchainAPI(host, port)
-    api.run_server()
\ No newline at end of file
+    api = BlockchainAPI(host, port, mining_workers, mining_threads, inference_server, lazy_load, mining_processes)
+    api.run_server()
\ No newline at end of file
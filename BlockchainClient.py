@@ -1,17 +1,36 @@
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 
 
 class BlockchainClient:
-    def __init__(self, host, port, print_response=False):
+    def __init__(self, host, port, print_response=False, timeout=30, retries=3, pool_size=10):
         self.host = host
         self.port = port
         self.url = f"http://{self.host}:{self.port}"
         self.print_response = print_response
-
-    def _send_get_request(self, endpoint):
+        # Seconds to wait for the connection and then for the response
+        self.timeout = timeout
+
+        # One keep-alive session for all calls, with up to pool_size connections for the concurrent calls
+        # Only failed connections and gateway errors are retried, a request that may have reached
+        # the server (e.g. /mine_block) is never sent twice
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=0.1, status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def _send_get_request(self, endpoint, params=None):
         url = self.url + endpoint
-        response = requests.get(url)
+        try:
+            response = self.session.get(url, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(e)
+            return None
         return self._process_response(response)
 
     def _process_response(self, response):
@@ -22,24 +41,89 @@ class BlockchainClient:
                 print(json_string)
             return data
 
+    def concurrently(self, *calls):
+        # Send several requests at once and return their results in order, e.g.
+        # concurrently((self.get_chain, id), (self.check_valid, id)) takes as long as the slower of the two
+        futures = [self.executor.submit(*call) for call in calls]
+        return [future.result() for future in futures]
+
     def create_chain(self, id):
-        endpoint = f"/create_chain?id={id}"
-        return self._send_get_request(endpoint)
+        endpoint = f"/create_chain"
+        return self._send_get_request(endpoint, {'id': id})
 
     def mine_block(self, id, course_title, course_description, transaction_hash):
-        endpoint = f"/mine_block?id={id}&course_title={course_title}&course_description={course_description}&transaction_hash={transaction_hash}"
-        return self._send_get_request(endpoint)
-
-    def get_chain(self, id):
-        endpoint = f"/get_chain?id={id}"
-        return self._send_get_request(endpoint)
-    
-    def get_prediction(self, id):
-        endpoint = f"/get_prediction?id={id}"
-        return self._send_get_request(endpoint)
-
-    def check_valid(self, id):
-        endpoint = f"/check_valid?id={id}"
+        endpoint = f"/mine_block"
+        params = {
+            'id': id,
+            'course_title': course_title,
+            'course_description': course_description,
+            'transaction_hash': transaction_hash
+        }
+        return self._send_get_request(endpoint, params)
+
+    def mine_status(self, job_id):
+        endpoint = f"/mine_status"
+        return self._send_get_request(endpoint, {'job_id': job_id})
+
+    def get_chain(self, id, from_index=None, limit=None, since_hash=None):
+        # Without a range the whole chain, from_index may be negative to count from the tip
+        endpoint = f"/get_chain"
+        params = {
+            'id': id,
+            'from_index': from_index,
+            'limit': limit,
+            'since_hash': since_hash
+        }
+        return self._send_get_request(endpoint, params)
+
+    def get_prediction(self, id, from_index=None, limit=None):
+        endpoint = f"/get_prediction"
+        params = {
+            'id': id,
+            'from_index': from_index,
+            'limit': limit
+        }
+        return self._send_get_request(endpoint, params)
+
+    def check_valid(self, id, full=False):
+        endpoint = f"/check_valid"
+        return self._send_get_request(endpoint, {'id': id, 'full': str(full).lower()})
+
+    def get_profile(self, id, from_index=None, limit=None, fields=None, full=False, if_height=None, if_tip_hash=None):
+        # Chain, ESG scores and validity in one request, fields selects some of 'chain', 'scores' and 'valid'
+        # With the height and tip hash of a profile the caller has, the answer is {'modified': False, ...} if it is current
+        endpoint = f"/profile"
+        params = {
+            'id': id,
+            'from_index': from_index,
+            'limit': limit,
+            'fields': ','.join(fields) if fields != None else None,
+            'full': str(full).lower(),
+            'if_height': if_height,
+            'if_tip_hash': if_tip_hash
+        }
+        return self._send_get_request(endpoint, params)
+
+    def check_all(self, difficulty=4):
+        # The response is streamed as one JSON line per chain followed by a summary line,
+        # the audit of a chain may take longer than the timeout so only connecting is timed
+        url = self.url + f"/check_all"
+        try:
+            response = self.session.get(url, params={'difficulty': difficulty}, stream=True, timeout=(self.timeout, None))
+        except requests.RequestException as e:
+            print(e)
+            return None
+        if response.status_code == 200:
+            result = None
+            for line in response.iter_lines():
+                if line:
+                    result = json.loads(line)
+                    if self.print_response == True:
+                        print(json.dumps(result))
+            return result['summary']
+
+    def health(self):
+        endpoint = f"/health"
         return self._send_get_request(endpoint)
 
     def print_menu(self):
@@ -49,6 +133,10 @@ class BlockchainClient:
         print("3 - Get chain")
         print("4 - Get ESG prediction")
         print("5 - Check validity")
+        print("6 - Get mining status")
+        print("7 - Check validity of all chains")
+        print("8 - Get server health")
+        print("9 - Get profile")
         print("==============================")
 
     def handle_option(self, option):
@@ -70,6 +158,16 @@ class BlockchainClient:
         elif option == "5":
             id = input("Enter id: ")
             self.check_valid(id)
+        elif option == "6":
+            job_id = input("Enter job id: ")
+            self.mine_status(job_id)
+        elif option == "7":
+            self.check_all()
+        elif option == "8":
+            self.health()
+        elif option == "9":
+            id = input("Enter id: ")
+            self.get_profile(id)
         else:
             return False
 
@@ -88,4 +186,4 @@ if __name__ == '__main__':
         option = input("Enter option: ")
 
         if not client.handle_option(option):
-            continue
\ No newline at end of file
+            continue
\ No newline at end of file
@@ -0,0 +1,408 @@
+import os
+import json
+import queue
+import threading
+from Blockchain import Blockchain, ChainRegistry, BlockEncoder, BlockchainEncoder, normalize_id, block_from_dict, blockchain_from_dict
+
+try:
+    import fcntl
+except ImportError:
+    # On Windows a second process writing the same database is not detected
+    fcntl = None
+
+
+def iter_json_array(json_file, chunk_size=1 << 20):
+    # Yield the elements of the top-level JSON array of a file one by one, reading the file in chunks
+    for element, _, _ in iter_json_array_spans(json_file, chunk_size):
+        yield element
+
+
+def iter_json_array_spans(json_file, chunk_size=1 << 20):
+    # Same as iter_json_array, with the start and end position of every element in the file
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # Position in the file of the first character of the buffer
+    buffer_start = 0
+    position = 0
+    eof = False
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\n\r,':
+            position += 1
+
+        parsed = False
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise json.JSONDecodeError("Expecting '['", buffer, position)
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                start = position
+                element, position = decoder.raw_decode(buffer, position)
+                parsed = True
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+
+        if parsed:
+            yield element, buffer_start + start, buffer_start + position
+            continue
+        if eof:
+            raise json.JSONDecodeError('Unterminated array', buffer, position)
+
+        # Keep the unparsed rest and read more, at least doubling it so a large element is parsed in few tries
+        buffer = buffer[position:]
+        buffer_start += position
+        position = 0
+        chunk = json_file.read(max(chunk_size, len(buffer)))
+        eof = chunk == ''
+        buffer += chunk
+
+
+def append_replayed_block(blockchain, block):
+    # Append a block of the log to its chain, skipping a block the chain already has
+    # A block past the end of the chain means a block is missing from the database, that is never skipped silently
+    if block.index > len(blockchain.chain):
+        raise ValueError(f"The block log is missing block {len(blockchain.chain)} of chain {blockchain.id} before block {block.index}")
+    if block.index == len(blockchain.chain):
+        blockchain.chain.append(block)
+
+
+class LazyChainRegistry(ChainRegistry):
+    # A registry whose snapshot chains are only parsed the first time they are asked for by id,
+    # so startup costs one scan of the snapshot for the byte offset of every chain
+    def __init__(self, snapshot_path, offsets):
+        super().__init__()
+        self.snapshot_path = snapshot_path
+        # Normalized id -> (start, end) in the snapshot of the chains not parsed yet
+        self.offsets = offsets
+        # Chains not parsed yet hold their place as None, so the chains keep the order of the snapshot
+        self.chains = dict.fromkeys(offsets)
+        # Blocks of the log waiting for their chain to be parsed
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        # Iterating over all chains (compaction, audits) parses the ones not parsed yet
+        self.load_all()
+        return super().__iter__()
+
+    def add(self, blockchain):
+        with self.lock:
+            self.offsets.pop(normalize_id(blockchain.id), None)
+            super().add(blockchain)
+
+    def get(self, id):
+        key = normalize_id(id)
+        if key in self.offsets:
+            with self.lock:
+                if key in self.offsets:
+                    self.load_chain(key)
+        return self.chains.get(key)
+
+    def add_pending(self, id, block):
+        # Keep a block of the log for a chain that is not parsed yet, False if the chain is parsed or unknown
+        key = normalize_id(id)
+        with self.lock:
+            if key not in self.offsets:
+                return False
+            self.pending.setdefault(key, []).append(block)
+            return True
+
+    def load_all(self):
+        with self.lock:
+            # In file order, so the snapshot is read front to back
+            for key in sorted(self.offsets, key=lambda key: self.offsets[key][0]):
+                self.load_chain(key)
+
+    def load_chain(self, key):
+        start, end = self.offsets.pop(key)
+        with open(self.snapshot_path, 'rb') as json_file:
+            json_file.seek(start)
+            blockchain = blockchain_from_dict(json.loads(json_file.read(end - start)))
+
+        for block in self.pending.pop(key, ()):
+            append_replayed_block(blockchain, block)
+        self.chains[key] = blockchain
+
+
+class BlockchainStorage:
+    def __init__(self, snapshot_path, log_path, compaction_threshold=10000):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        # Compact once the log holds more records than this, or more records than the snapshot holds blocks,
+        # so that the cost of rewriting the snapshot is amortized over the appends since the last compaction
+        self.compaction_threshold = compaction_threshold
+        self.snapshot_blocks = 0
+        self.log_records = 0
+        self.log_file = None
+        # Appends and compactions come from the request and mining threads, a single writer thread
+        # does them one after the other, so the snapshot is never written by two threads at once
+        self.requests = queue.Queue()
+        self.writer = None
+        self.compaction_pending = False
+        self.lock = threading.Lock()
+        # e.g. ./database/chains.lock, held by the one process that writes the database
+        self.lock_path = os.path.splitext(snapshot_path)[0] + '.lock'
+        self.lock_file = None
+
+    def load(self, repair=True, lazy=False):
+        # Load the last snapshot, then replay the blocks appended after it
+        # With lazy, chains of the snapshot are only parsed when first looked up by id
+        # repair (which may cut a torn record off the log) is only done by the process that writes the database
+        if repair:
+            self.lock_database()
+        all_chains = self.index_snapshot() if lazy else self.load_snapshot()
+        if not lazy:
+            self.snapshot_blocks = sum(len(blockchain.chain) for blockchain in all_chains)
+        self.log_records = self.replay_log(all_chains, repair)
+        return all_chains
+
+    def lock_database(self):
+        # Two processes appending to the same log would lose blocks, the second one fails right away instead
+        if fcntl == None or self.lock_file != None:
+            return
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"{self.lock_path} is locked, another process is writing the database (run one worker process, e.g. gunicorn -w 1)")
+        self.lock_file = lock_file
+
+    def load_snapshot(self):
+        # Chain by chain, each one is built from its parsed JSON before the next one is read
+        loaded_chains = ChainRegistry()
+        try:
+            with open(self.snapshot_path, 'r') as json_file:
+                for chain in iter_json_array(json_file):
+                    loaded_chains.add(blockchain_from_dict(chain))
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(e)
+            loaded_chains = ChainRegistry()
+        return loaded_chains
+
+    def index_snapshot(self):
+        # The byte offsets of every chain in the snapshot, which json.dump writes in ASCII,
+        # so positions in the text read as latin-1 are positions in the file
+        offsets = {}
+        self.snapshot_blocks = 0
+        try:
+            with open(self.snapshot_path, 'r', encoding='latin-1', newline='') as json_file:
+                for chain, start, end in iter_json_array_spans(json_file):
+                    offsets[normalize_id(chain['id'])] = (start, end)
+                    self.snapshot_blocks += len(chain['chain'])
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(e)
+            offsets = {}
+            self.snapshot_blocks = 0
+        return LazyChainRegistry(self.snapshot_path, offsets)
+
+    def read_log(self):
+        # Yield every complete record of the log with the length of the log up to and including it
+        valid_length = 0
+        try:
+            with open(self.log_path, 'rb') as log_file:
+                for line in log_file:
+                    # A torn record can only be the last line, left by a crash in the middle of an append
+                    if not line.endswith(b'\n'):
+                        return
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        return
+                    valid_length += len(line)
+                    yield record, valid_length
+        except FileNotFoundError:
+            return
+
+    def replay_log(self, all_chains, repair=True):
+        records = 0
+        valid_length = 0
+        for record, valid_length in self.read_log():
+            records += 1
+            block = block_from_dict(record['block'])
+            if isinstance(all_chains, LazyChainRegistry) and all_chains.add_pending(record['id'], block):
+                continue
+
+            blockchain = all_chains.get(record['id'])
+            if blockchain == None:
+                blockchain = Blockchain(record['id'])
+                all_chains.add(blockchain)
+
+            # Blocks already in the snapshot are skipped, so replaying a log that survived a
+            # compaction (crash between the snapshot rename and the log truncation) is harmless
+            append_replayed_block(blockchain, block)
+
+        # Drop the torn tail so that the next append starts on a record boundary
+        if repair and os.path.exists(self.log_path) and valid_length != os.path.getsize(self.log_path):
+            with open(self.log_path, 'r+b') as log_file:
+                log_file.truncate(valid_length)
+        return records
+
+    def iter_raw_chains(self):
+        # Yield the id and the blocks (as dicts) of every chain without building the whole database in memory,
+        # the snapshot is streamed chain by chain and only the log, which compaction keeps short, is held
+        log_chains = {}
+        for record, _ in self.read_log():
+            log_chains.setdefault(normalize_id(record['id']), (record['id'], []))[1].append(record['block'])
+
+        try:
+            with open(self.snapshot_path, 'r') as json_file:
+                for chain in iter_json_array(json_file):
+                    _, log_blocks = log_chains.pop(normalize_id(chain['id']), (None, []))
+                    blocks = chain['chain']
+                    blocks.extend(block for block in log_blocks if block['index'] >= len(blocks))
+                    yield chain['id'], blocks
+        except FileNotFoundError as e:
+            print(e)
+
+        for id, log_blocks in log_chains.values():
+            yield id, log_blocks
+
+    def queue_block(self, id, block):
+        # Queue the record of a single block of the chain id, records are written in the order they are queued
+        # and wait(request) returns once it is fsynced, the cost is independent of the database size
+        record = json.dumps({'id': id, 'block': block}, cls=BlockEncoder)
+        return self.queue_request('append', record.encode('utf-8') + b'\n', True)
+
+    def should_compact(self):
+        return not self.compaction_pending and self.log_records > max(self.compaction_threshold, self.snapshot_blocks)
+
+    def compact(self, all_chains, wait=True):
+        # Write a new snapshot of all chains and empty the log, without wait the writer does it in the background
+        with self.lock:
+            if not wait and self.compaction_pending:
+                return
+            self.compaction_pending = True
+        self.request('compact', all_chains, wait)
+
+    def request(self, operation, argument, wait):
+        request = self.queue_request(operation, argument, wait)
+        if wait:
+            self.wait(request)
+
+    def queue_request(self, operation, argument, wait):
+        with self.lock:
+            if self.writer == None:
+                self.writer = threading.Thread(target=self.write, daemon=True)
+                self.writer.start()
+
+        request = {
+            'operation': operation,
+            'argument': argument,
+            'wait': wait,
+            'done': threading.Event(),
+            'error': None
+        }
+        self.requests.put(request)
+        return request
+
+    def wait(self, request):
+        # Block until the writer has done the request, raise its error if it failed
+        request['done'].wait()
+        if request['error'] != None:
+            raise request['error']
+
+    def write(self):
+        # The writer thread, every record queued while the previous fsync ran is written with one fsync (group commit)
+        while True:
+            batch = [self.requests.get()]
+            while True:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            appends = []
+            for request in batch:
+                if request == None:
+                    self.commit(appends)
+                    if self.log_file != None:
+                        self.log_file.close()
+                        self.log_file = None
+                    return
+                if request['operation'] == 'append':
+                    appends.append(request)
+                else:
+                    # The records requested before the compaction are written first
+                    self.commit(appends)
+                    appends = []
+                    self.finish([request], self.write_snapshot, request['argument'])
+            self.commit(appends)
+
+    def commit(self, appends):
+        if len(appends) > 0:
+            self.finish(appends, self.write_log, [request['argument'] for request in appends])
+
+    def finish(self, requests, operation, argument):
+        # Any error goes to the waiting threads, the writer thread itself keeps running for the next requests
+        error = None
+        try:
+            operation(argument)
+        except Exception as e:
+            error = e
+            if not any(request['wait'] for request in requests):
+                print(e)
+        for request in requests:
+            request['error'] = error
+            request['done'].set()
+
+    def write_log(self, records):
+        if self.log_file == None:
+            self.log_file = open(self.log_path, 'ab')
+        self.log_file.write(b''.join(records))
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.log_records += len(records)
+
+    def write_snapshot(self, all_chains):
+        # Write a new snapshot next to the old one and atomically swap it in, then start an empty log
+        # Blocks appended to the chains while they are written are either in the snapshot or logged after it,
+        # since a block is added to its chain (and a chain to the registry) before its record is queued
+        try:
+            chains = list(all_chains)
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'w') as json_file:
+                json.dump(chains, json_file, cls=BlockchainEncoder)
+                json_file.flush()
+                os.fsync(json_file.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            sync_directory(self.snapshot_path)
+
+            if self.log_file != None:
+                self.log_file.close()
+                self.log_file = None
+            with open(self.log_path, 'wb') as log_file:
+                os.fsync(log_file.fileno())
+
+            self.snapshot_blocks = sum(len(blockchain.chain) for blockchain in chains)
+            self.log_records = 0
+        finally:
+            self.compaction_pending = False
+
+    def close(self):
+        # Write what is queued and stop the writer thread
+        with self.lock:
+            writer = self.writer
+            self.writer = None
+        if writer != None:
+            self.requests.put(None)
+            writer.join()
+        if self.lock_file != None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def sync_directory(path):
+    # Make a rename in the directory of the path durable, directories cannot be opened for this on Windows
+    if hasattr(os, 'O_DIRECTORY'):
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
@@ -0,0 +1,100 @@
+import sys
+import os
+import csv
+import multiprocessing
+import numpy as np
+from AI import AI
+from BlockchainStorage import BlockchainStorage
+
+
+_model = None
+
+
+def _init_scoring_worker(model_path, batch_size, num_threads, token_cache_path):
+    global _model
+    from BERT import BERTModel
+    _model = BERTModel(model_path, batch_size=batch_size, num_threads=num_threads, token_cache_path=token_cache_path)
+
+
+def _score_texts(texts):
+    _, predictions_prob = _model.get_predictions(texts)
+    return np.array([prob[0] for prob in predictions_prob])
+
+
+class BulkScoring:
+    # Offline ESG scoring of a whole corpus, e.g. to recompute every wallet after the model is retrained
+    def __init__(self, model_path='./models/MLTC_model_state.bin', workers=1, batch_size=64, chunk_size=1024, token_cache_path='./database/tokens.sqlite'):
+        self.model_path = model_path
+        self.workers = workers
+        self.batch_size = batch_size
+        # Number of unique texts handed to a worker at a time
+        self.chunk_size = chunk_size
+        self.token_cache_path = token_cache_path
+        # Only the scoring helpers of AI are used here, nothing is read from or written to the prediction cache
+        self.AI = AI(model_path, prediction_cache_path=None, token_cache_path=None)
+
+    def chain_entries(self, storage):
+        # (wallet id, course texts) of every chain, streamed from the snapshot and the block log
+        for id, blocks in storage.iter_raw_chains():
+            yield id, [block['data']['course_title'] + '. ' + block['data']['course_description'] for block in blocks[1:]]
+
+    def course_entries(self, courses_path):
+        # (link, [course text]) of every row of a courses CSV file
+        with open(courses_path, 'r', encoding='utf-8') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield row['link'], [row['title'] + '. ' + row['description']]
+
+    def score_texts(self, texts):
+        # The probabilities of all texts, in chunks spread across the worker processes
+        chunks = [texts[start:start + self.chunk_size] for start in range(0, len(texts), self.chunk_size)]
+        if len(chunks) == 0:
+            return np.zeros((0, 30))
+
+        num_threads = max(os.cpu_count() // self.workers, 1)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(self.workers, initializer=_init_scoring_worker, initargs=(self.model_path, self.batch_size, num_threads, self.token_cache_path)) as pool:
+            return np.concatenate(pool.map(_score_texts, chunks, chunksize=1))
+
+    def score(self, entries, output_path):
+        # Each distinct course text is scored once, however many wallets it appears in
+        ids = []
+        entry_indices = []
+        text_indices = {}
+        for id, texts in entries:
+            ids.append(id)
+            entry_indices.append([text_indices.setdefault(text, len(text_indices)) for text in texts])
+
+        probabilities = self.score_texts(list(text_indices))
+
+        # Expand the distinct rows back to one row per course of every entry and aggregate them per entry
+        offsets = np.cumsum([0] + [len(indices) for indices in entry_indices])[:-1]
+        rows = np.array([index for indices in entry_indices for index in indices], dtype=np.int64)
+        normalized_prob = self.AI.normalize_probabilities(probabilities)[rows]
+        ESG_scores = self.AI.total_ESG_scores_from_segments(normalized_prob, offsets)
+
+        # One array per column
+        np.savez_compressed(
+            output_path,
+            id=np.array(ids),
+            courses=np.array([len(indices) for indices in entry_indices]),
+            E=ESG_scores[:, 0],
+            S=ESG_scores[:, 1],
+            G=ESG_scores[:, 2]
+        )
+        print(f"{len(ids)} entries, {len(text_indices)} distinct courses scored, written to {output_path}")
+
+
+if __name__ == '__main__':
+    # e.g. python BulkScoring.py chains scores.npz [workers] [batch size]
+    #      python BulkScoring.py courses scores.npz [workers] [batch size]
+    source = sys.argv[1]
+    output_path = sys.argv[2]
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+
+    bulk_scoring = BulkScoring(workers=workers, batch_size=batch_size)
+    if source == 'chains':
+        storage = BlockchainStorage('./database/chains.json', './database/chains.log')
+        bulk_scoring.score(bulk_scoring.chain_entries(storage), output_path)
+    else:
+        bulk_scoring.score(bulk_scoring.course_entries('./models/courses.csv'), output_path)
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+from collections import OrderedDict
+import numpy as np
+
+
+def text_key(text):
+    # Content address of a text, identical course texts share one cache entry whichever chain they are in
+    return sha256(text.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, max_entries=10000, ttl=None):
+        self.max_entries = max_entries
+        # Seconds an entry is kept after it is put, None keeps it until it is evicted
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.expires_at = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and self.ttl != None and self.expires_at[key] <= time.monotonic():
+                del self.entries[key]
+                del self.expires_at[key]
+                value = None
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if self.ttl != None:
+                self.expires_at[key] = time.monotonic() + self.ttl
+            while len(self.entries) > self.max_entries:
+                evicted_key, _ = self.entries.popitem(last=False)
+                self.expires_at.pop(evicted_key, None)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.expires_at.pop(key, None)
+
+
+class DiskCache:
+    def __init__(self, path, table):
+        self.table = table
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB)")
+        self.connection.commit()
+
+    def get_many(self, keys):
+        values = {}
+        with self.lock:
+            # Stay below the SQLite limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                query = f"SELECT key, value FROM {self.table} WHERE key IN ({', '.join('?' * len(batch))})"
+                values.update(self.connection.execute(query, batch).fetchall())
+        return values
+
+    def put_many(self, items):
+        with self.lock:
+            self.connection.executemany(f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", items)
+            self.connection.commit()
+
+
+class ArrayCache:
+    # A NumPy array per text, in a bounded in-memory tier and optionally an on-disk tier that survives restarts
+    def __init__(self, path, table, dtype, max_entries=10000, version=''):
+        # The version (e.g. of the model file) is part of every key, so a new version never sees old values
+        self.dtype = dtype
+        self.version = version
+        self.memory = LRUCache(max_entries)
+        self.disk = DiskCache(path, table) if path != None else None
+
+    def key(self, text):
+        return self.version + ':' + text_key(text)
+
+    def get_many(self, texts):
+        # The cached arrays of the texts, None for the texts that are not cached yet
+        keys = [self.key(text) for text in texts]
+        arrays = [self.memory.get(key) for key in keys]
+
+        missing_keys = [key for key, array in zip(keys, arrays) if array is None]
+        if self.disk != None and len(missing_keys) > 0:
+            stored = self.disk.get_many(missing_keys)
+            for i, key in enumerate(keys):
+                if arrays[i] is None and key in stored:
+                    arrays[i] = np.frombuffer(stored[key], dtype=self.dtype)
+                    self.memory.put(key, arrays[i])
+        return arrays
+
+    def put_many(self, texts, arrays):
+        keys = [self.key(text) for text in texts]
+        arrays = [np.asarray(array, dtype=self.dtype) for array in arrays]
+        for key, array in zip(keys, arrays):
+            self.memory.put(key, array)
+        if self.disk != None:
+            self.disk.put_many([(key, array.tobytes()) for key, array in zip(keys, arrays)])
+
+
+class PredictionCache(ArrayCache):
+    # The 30 probabilities of the model per course text, float32 holds the sigmoid outputs of the model exactly
+    def __init__(self, path=None, max_entries=10000, version=''):
+        super().__init__(path, 'predictions', np.float32, max_entries, version)
+
+    def get_many(self, texts):
+        return [row.astype(np.float64) if row is not None else None for row in super().get_many(texts)]
+
+
+class TokenCache(ArrayCache):
+    # The token ids of each course text, so that a text is tokenized once whichever chain it is in
+    def __init__(self, path=None, max_entries=100000, version=''):
+        super().__init__(path, 'tokens', np.int32, max_entries, version)
+
+    def get_many(self, texts):
+        return [input_ids.tolist() if input_ids is not None else None for input_ids in super().get_many(texts)]
+
+
+class ChainJSONCache:
+    # The JSON array of the blocks of each chain, when a chain grows only its new blocks are serialized,
+    # so answering for a chain that did not change is a copy of the cached bytes
+    def __init__(self, dumps, max_entries=1000):
+        # dumps(block) gives the JSON text of one block
+        self.dumps = dumps
+        self.entries = LRUCache(max_entries)
+
+    def get(self, key, chain):
+        # Blocks are only ever appended, a chain is in the cache as (number of blocks, hash of its last block, JSON)
+        length = len(chain)
+        entry = self.entries.get(key)
+        if entry != None and 0 < entry[0] <= length and chain[entry[0] - 1].hash == entry[1]:
+            count, _, cached_json = entry
+            if count == length:
+                return cached_json
+        else:
+            count, cached_json = 0, b'[]'
+
+        new_json = ','.join(self.dumps(block) for block in chain[count:length]).encode('utf-8')
+        chain_json = cached_json[:-1] + (b',' if count > 0 else b'') + new_json + b']'
+        if length > 0:
+            self.entries.put(key, (length, chain[length - 1].hash, chain_json))
+        return chain_json
+
+    def remove(self, key):
+        self.entries.remove(key)
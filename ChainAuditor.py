@@ -0,0 +1,74 @@
+import sys
+import json
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from Blockchain import Blockchain
+from BlockchainStorage import BlockchainStorage
+
+
+def audit_chain(id, chain, difficulty):
+    blockchain = Blockchain(id)
+    blockchain.chain = chain
+    bad_index = blockchain.find_invalid_block(0, difficulty)
+    return {
+        'id': id,
+        'length': len(chain),
+        'valid': bad_index == None,
+        'first_bad_index': bad_index
+    }
+
+
+class ChainAuditor:
+    def __init__(self, workers=None, difficulty=4, chunksize=16):
+        # Never more processes than cores, workers may come straight from a request parameter
+        self.workers = max(1, min(workers or os.cpu_count(), os.cpu_count()))
+        self.difficulty = difficulty
+        self.chunksize = chunksize
+        self.summary = None
+
+    def audit(self, all_chains):
+        # Yield the result of every chain in order, while the following chains are still being verified
+        # The chains are copied first so that blocks mined during the audit do not race with pickling
+        ids = []
+        chains = []
+        for blockchain in all_chains:
+            ids.append(blockchain.id)
+            chains.append(blockchain.chain[:])
+
+        # Spawned rather than forked, the auditor runs inside the threaded server
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            yield from executor.map(audit_chain, ids, chains, [self.difficulty] * len(ids), chunksize=self.chunksize)
+
+    def stream(self, all_chains):
+        # One JSON line per chain, then a line with the summary of all invalid chains
+        summary = {
+            'chains': 0,
+            'valid': 0,
+            'invalid': []
+        }
+        for result in self.audit(all_chains):
+            summary['chains'] += 1
+            if result['valid']:
+                summary['valid'] += 1
+            else:
+                summary['invalid'].append({'id': result['id'], 'first_bad_index': result['first_bad_index']})
+            yield json.dumps(result) + '\n'
+
+        self.summary = summary
+        yield json.dumps({'summary': summary}) + '\n'
+
+
+if __name__ == '__main__':
+    # e.g. python ChainAuditor.py [workers] [difficulty]
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    difficulty = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    # The database may be in use by BlockchainAPI, so it is only read and never repaired
+    storage = BlockchainStorage('./database/chains.json', './database/chains.log')
+    auditor = ChainAuditor(workers, difficulty)
+
+    for line in auditor.stream(storage.load(repair=False)):
+        print(line, end='', flush=True)
+
+    sys.exit(0 if len(auditor.summary['invalid']) == 0 else 1)
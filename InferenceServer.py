@@ -0,0 +1,164 @@
+import multiprocessing
+import threading
+import itertools
+import queue
+import time
+
+
+def _serve(model_path, max_batch_size, max_wait, quantize, num_threads, token_cache_path, requests, responses):
+    # Runs in the inference process: collect requests for up to max_wait seconds or max_batch_size texts,
+    # run them through the model as one batch and send every caller its own rows back
+    try:
+        from BERT import BERTModel
+        model = BERTModel(model_path, batch_size=max_batch_size, quantize=quantize, num_threads=num_threads, token_cache_path=token_cache_path)
+    except Exception as e:
+        responses.put(('failed', str(e)))
+        return
+    responses.put(('ready', None))
+
+    stopping = False
+    while not stopping:
+        request = requests.get()
+        if request == None:
+            return
+
+        batch = [request]
+        batch_texts = len(request[1])
+        deadline = time.monotonic() + max_wait
+        while batch_texts < max_batch_size:
+            try:
+                request = requests.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request == None:
+                stopping = True
+                break
+            batch.append(request)
+            batch_texts += len(request[1])
+
+        started_at = time.time()
+        texts = [text for _, request_texts, _ in batch for text in request_texts]
+        try:
+            predictions, predictions_prob = model.get_predictions(texts)
+            error = None
+        except Exception as e:
+            error = str(e)
+
+        start = 0
+        for request_id, request_texts, enqueued_at in batch:
+            end = start + len(request_texts)
+            stats = {
+                'batch_texts': len(texts),
+                'queue_latency': started_at - enqueued_at
+            }
+            if error == None:
+                responses.put((request_id, (predictions[start:end], predictions_prob[start:end]), stats))
+            else:
+                responses.put((request_id, RuntimeError(error), stats))
+            start = end
+
+
+class InferenceServer:
+    # Runs BERTModel in its own process and micro-batches the requests of all callers,
+    # get_predictions can be used in place of BERTModel.get_predictions from any number of threads
+    def __init__(self, model_path, max_batch_size=64, max_wait=0.01, quantize=False, num_threads=None, token_cache_path=None):
+        self.max_batch_size = max_batch_size
+        # torch is not safe to use in a forked process
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.responses = context.Queue()
+        self.process = context.Process(
+            target=_serve,
+            args=(model_path, max_batch_size, max_wait, quantize, num_threads, token_cache_path, self.requests, self.responses),
+            daemon=True
+        )
+        self.process.start()
+
+        # The process may die without a word (e.g. killed for lack of memory) while it loads the model
+        while True:
+            try:
+                status, error = self.responses.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f"The inference process exited with code {self.process.exitcode} before the model was loaded")
+        if status == 'failed':
+            self.process.join()
+            raise RuntimeError(error)
+
+        self.lock = threading.Lock()
+        # Why the inference process can no longer serve, None while it is alive
+        self.error = None
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.requests_served = 0
+        self.batch_texts = 0
+        self.queue_latency = 0.0
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def dispatch(self):
+        # Hand every response to the thread waiting for it
+        while True:
+            try:
+                response = self.responses.get(timeout=1)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                # Nobody will answer the pending requests anymore
+                with self.lock:
+                    self.error = f"The inference process exited with code {self.process.exitcode}"
+                    for waiter in self.pending.values():
+                        waiter[1] = RuntimeError(self.error)
+                        waiter[0].set()
+                return
+            if response == None:
+                return
+            request_id, result, stats = response
+            with self.lock:
+                waiter = self.pending[request_id]
+                self.requests_served += 1
+                self.batch_texts += stats['batch_texts']
+                self.queue_latency += stats['queue_latency']
+            waiter[1] = result
+            waiter[0].set()
+
+    def get_predictions(self, input, batch_size=None):
+        if len(input) == 0:
+            return [], []
+
+        waiter = [threading.Event(), None]
+        with self.lock:
+            if self.error != None:
+                raise RuntimeError(self.error)
+            request_id = next(self.request_ids)
+            self.pending[request_id] = waiter
+        self.requests.put((request_id, list(input), time.time()))
+
+        waiter[0].wait()
+        with self.lock:
+            del self.pending[request_id]
+        if isinstance(waiter[1], Exception):
+            raise waiter[1]
+        return waiter[1]
+
+    def metrics(self):
+        # Averages per request of how full its batch was and how long it waited before its batch started
+        with self.lock:
+            served = max(self.requests_served, 1)
+            return {
+                'alive': self.error == None,
+                'requests': self.requests_served,
+                'pending': len(self.pending),
+                'max_batch_size': self.max_batch_size,
+                'average_batch_fill': self.batch_texts / served / self.max_batch_size,
+                'average_queue_latency': self.queue_latency / served
+            }
+
+    def close(self):
+        with self.lock:
+            self.error = "The inference server is closed"
+        self.requests.put(None)
+        self.process.join()
+        self.responses.put(None)
+        self.dispatcher.join()
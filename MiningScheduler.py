@@ -0,0 +1,84 @@
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Blockchain import normalize_id
+
+
+class MiningScheduler:
+    def __init__(self, mine, workers=4, max_finished_jobs=10000):
+        # mine(id, data) mines one block on the chain of the id and returns it
+        self.mine = mine
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_finished_jobs = max_finished_jobs
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.finished_jobs = deque()
+        # Jobs waiting per chain, a chain is in here exactly while one worker is draining its queue
+        self.queues = {}
+
+    def submit(self, id, data):
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'id': id,
+            'status': 'pending',
+            'data': data
+        }
+
+        with self.condition:
+            self.jobs[job['job_id']] = job
+            key = normalize_id(id)
+            if key in self.queues:
+                self.queues[key].append(job)
+            else:
+                self.queues[key] = deque([job])
+                self.executor.submit(self.drain, key)
+
+        return job['job_id']
+
+    def drain(self, key):
+        # Mine the queued blocks of one chain in order, so blocks of a chain never race each other
+        while True:
+            with self.condition:
+                queue = self.queues[key]
+                if len(queue) == 0:
+                    del self.queues[key]
+                    return
+                job = queue[0]
+                job['status'] = 'mining'
+
+            try:
+                block = self.mine(job['id'], job.pop('data'))
+                result = {'status': 'mined', 'index': block.index, 'hash': block.hash}
+            except Exception as e:
+                print(e)
+                result = {'status': 'failed', 'error': str(e)}
+
+            with self.condition:
+                job.update(result)
+                queue.popleft()
+                self.finished_jobs.append(job['job_id'])
+                while len(self.finished_jobs) > self.max_finished_jobs:
+                    del self.jobs[self.finished_jobs.popleft()]
+                self.condition.notify_all()
+
+    def status(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job == None:
+                return None
+            return {key: value for key, value in job.items() if key != 'data'}
+
+    def pending_count(self, id):
+        with self.condition:
+            return len(self.queues.get(normalize_id(id), ()))
+
+    def wait(self, job_id, timeout=None):
+        # Block until the job is mined or failed, then return its status, None if there is no such job
+        # The job itself is held on to, so its result is returned even if it is pruned from jobs meanwhile
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job == None:
+                return None
+            self.condition.wait_for(lambda: job['status'] in ('mined', 'failed'), timeout)
+            return {key: value for key, value in job.items() if key != 'data'}
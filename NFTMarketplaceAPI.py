@@ -1,16 +1,40 @@
 from flask import Flask, request, jsonify
 import json
+import os
+import threading
+from contextlib import contextmanager
 from BlockchainClient import BlockchainClient
+from Blockchain import normalize_id
+from Cache import LRUCache
+
+try:
+    import fcntl
+except ImportError:
+    # On Windows the collections file is only locked between the threads of one process
+    fcntl = None
 
 
 class NFTMarketplaceAPI:
-    def __init__(self, host, port, BlockchainAPI_port):
+    def __init__(self, host, port, BlockchainAPI_port, profile_blocks=20, profile_cache_size=10000, profile_cache_ttl=60):
         self.host = host
         self.port = port
+        # Number of latest blocks shown in a profile, unless the request asks for another limit
+        self.profile_blocks = profile_blocks
+        # Profiles per wallet and limit with the height and tip hash of the chain they were built from,
+        # a profile is served again while the chain has not grown, for at most profile_cache_ttl seconds
+        self.profile_cache = LRUCache(profile_cache_size, profile_cache_ttl)
+        self.profile_cache_lock = threading.Lock()
+        self.profile_cache_hits = 0
+        self.profile_cache_misses = 0
+        self.profile_cache_invalidations = 0
         self.BlockchainAPI_port = BlockchainAPI_port
         self.BlockchainClient = BlockchainClient(host, BlockchainAPI_port)
         self.app = Flask(__name__)
         self.global_abi = self.load_global_abi()
+        # Several worker processes may serve the collections, each one rereads the file when another one changed it
+        self.collections_path = './database/collections.json'
+        self.collections_lock = threading.Lock()
+        self.collections_stat = None
         self.all_collections = self.load_all_collections()
 
     def load_global_abi(self):
@@ -29,53 +53,119 @@ class NFTMarketplaceAPI:
         # Load the object back from the JSON file
         loaded_collections = []
         try:
-            with open('./database/collections.json', 'r') as json_file:
+            # Taken before reading, so a change made while reading is picked up next time
+            self.collections_stat = self.stat_collections()
+            with open(self.collections_path, 'r') as json_file:
                 loaded_collections = json.load(json_file)
         except (FileNotFoundError, json.JSONDecodeError) as e:
             print(e)
         return loaded_collections
 
+    def stat_collections(self):
+        try:
+            stat = os.stat(self.collections_path)
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def current_collections(self):
+        # The collections, reread if another process wrote the file since it was last read
+        with self.collections_lock:
+            if self.stat_collections() != self.collections_stat:
+                self.all_collections = self.load_all_collections()
+            return self.all_collections
+
+    @contextmanager
+    def lock_collections_file(self):
+        # Serializes the read, append and write of the collections between worker processes
+        if fcntl == None:
+            yield
+            return
+        with open(self.collections_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
     def dump_all_collections(self):
-        # Dump the object to a JSON file
+        # Dump the object to a temporary JSON file and atomically replace the old one with it,
+        # so that other processes never read a half-written file
+        temp_path = f"{self.collections_path}.{os.getpid()}.tmp"
         try:
-            with open('./database/collections.json', 'w') as json_file:
+            with open(temp_path, 'w') as json_file:
                 json.dump(self.all_collections, json_file)
+                json_file.flush()
+                os.fsync(json_file.fileno())
+            os.replace(temp_path, self.collections_path)
+            self.collections_stat = self.stat_collections()
         except IOError as e:
             print(e)
 
     def update_contract_list(self):
         contract_address = request.args.get('contract_address')
-        self.all_collections.append(contract_address)
+        with self.collections_lock, self.lock_collections_file():
+            # Append to the latest list, another process may have added a collection since it was read
+            self.all_collections = self.load_all_collections() + [contract_address]
+            self.dump_all_collections()
+
         response = {
             'message': 'Collection list UPDATED',
             'contract_address': contract_address
         }
 
-        self.dump_all_collections()
-
         return jsonify(response), 200
 
     def get_contract_list(self):
         response = {
-            'all_collections': self.all_collections
+            'all_collections': self.current_collections()
         }
         
         return jsonify(response), 200
     
     def get_profile(self):
         wallet_address = request.args.get('wallet_address')
-        blockchain = self.BlockchainClient.get_chain(wallet_address)
-        ESG_scores = self.BlockchainClient.get_prediction(wallet_address)
-        is_valid = self.BlockchainClient.check_valid(wallet_address)
+        limit = max(request.args.get('limit', self.profile_blocks, type=int), 0)
+        key = (normalize_id(wallet_address), limit)
+
+        # A cached profile is sent along as its height and tip hash, BlockchainAPI only answers that it is
+        # still current or with the new profile, either way in one request
+        cached = self.profile_cache.get(key)
+        if cached != None:
+            profile = self.BlockchainClient.get_profile(wallet_address, -limit, limit, if_height=cached[0], if_tip_hash=cached[1])
+        else:
+            profile = self.BlockchainClient.get_profile(wallet_address, -limit, limit)
+        if profile == None:
+            # BlockchainAPI has no chain of the wallet or could not be reached
+            response = {
+                'message': 'The profile does NOT EXIST',
+                'wallet_address': wallet_address
+            }
+            return jsonify(response), 404
+
+        if profile.get('modified') == False:
+            with self.profile_cache_lock:
+                self.profile_cache_hits += 1
+            return jsonify({'wallet_address': wallet_address, **cached[2]}), 200
+
+        with self.profile_cache_lock:
+            self.profile_cache_misses += 1
+
+        # Scores start at the first course, the genesis block has none
+        from_index = max(profile['from_index'], 1)
 
         response = {
-            'wallet_address': wallet_address,
-            'chain': blockchain['chain'],
-            'ESG scores': ESG_scores["ESG scores"],
-            'valid': is_valid['message']
+            'chain': [block for block in profile['chain'] if block['index'] >= from_index],
+            'height': profile['height'],
+            # 'ESG scores' holds the total, then the scores of the blocks from from_index on
+            'from_index': from_index,
+            'ESG scores': profile['ESG scores'],
+            'valid': profile['valid']
         }
-        
-        return jsonify(response), 200
+        if profile['ESG scores'] == None:
+            # The model is not available, the profile is not cached so that the scores are filled in once it is
+            response['model'] = profile['model']
+        else:
+            self.profile_cache.put(key, (profile['height'], profile['tip_hash'], response))
+
+        return jsonify({'wallet_address': wallet_address, **response}), 200
     
     def update_profile(self):
         wallet_address = request.args.get('wallet_address')
@@ -83,15 +173,42 @@ class NFTMarketplaceAPI:
         course_description = request.args.get('course_description')
         transaction_hash = request.args.get('transaction_hash')
 
-        self.BlockchainClient.mine_block(wallet_address, course_title, course_description, transaction_hash)
+        # The block is mined in the background by BlockchainAPI, the job id can be polled with /mine_status
+        mining_job = self.BlockchainClient.mine_block(wallet_address, course_title, course_description, transaction_hash)
+        self.invalidate_profile(wallet_address)
         
         response = {
             'message': 'Profile UPDATED',
             'wallet_address': wallet_address,
+            'job_id': mining_job['job_id'] if mining_job != None else None
         }
         
         return jsonify(response), 200
     
+    def invalidate_profile(self, wallet_address):
+        # The profiles of the wallet for every limit
+        wallet = normalize_id(wallet_address)
+        for key in self.profile_cache.keys():
+            if key[0] == wallet:
+                self.profile_cache.remove(key)
+        with self.profile_cache_lock:
+            self.profile_cache_invalidations += 1
+
+    def cache_stats(self):
+        with self.profile_cache_lock:
+            requests = self.profile_cache_hits + self.profile_cache_misses
+            response = {
+                'entries': len(self.profile_cache),
+                'max_entries': self.profile_cache.max_entries,
+                'ttl': self.profile_cache.ttl,
+                'hits': self.profile_cache_hits,
+                'misses': self.profile_cache_misses,
+                'hit_rate': self.profile_cache_hits / requests if requests > 0 else None,
+                'invalidations': self.profile_cache_invalidations
+            }
+
+        return jsonify(response), 200
+
     def create_chain_if_not_exist(self):
         wallet_address = request.args.get('wallet_address')
         response = self.BlockchainClient.create_chain(wallet_address)
@@ -99,21 +216,40 @@ class NFTMarketplaceAPI:
         return jsonify(response), 200
 
 
-    def run_server(self):
+    def register_routes(self):
         self.app.route('/get_global_abi', methods=['GET'])(self.get_global_abi)
         self.app.route('/update_contract_list', methods=['GET'])(self.update_contract_list)
         self.app.route('/get_contract_list', methods=['GET'])(self.get_contract_list)
         self.app.route('/get_profile', methods=['GET'])(self.get_profile)
         self.app.route('/update_profile', methods=['GET'])(self.update_profile)
         self.app.route('/create_chain_if_not_exist', methods=['GET'])(self.create_chain_if_not_exist)
+        self.app.route('/cache_stats', methods=['GET'])(self.cache_stats)
+
+    def run_server(self):
+        # Flask's development server, create_app is the entry point for a production server
+        self.register_routes()
+        self.app.run(host=self.host, port=self.port, threaded=True)
+
 
-        self.app.run(host=self.host, port=self.port)
+def create_app(host="127.0.0.1", BlockchainAPI_port=5000, profile_blocks=20, profile_cache_size=10000, profile_cache_ttl=60):
+    # App factory for a production WSGI server, host and BlockchainAPI_port are where BlockchainAPI runs, e.g.
+    #   gunicorn -w 4 --threads 8 -b 127.0.0.1:5500 'NFTMarketplaceAPI:create_app()'
+    # Any number of worker processes can serve it, the collections are shared through the file,
+    # each worker has its own profile cache, which checks the chain tip on every hit
+    # Workers must create their app themselves (no --preload), BlockchainClient starts threads
+    api = NFTMarketplaceAPI(host, None, BlockchainAPI_port, profile_blocks, profile_cache_size, profile_cache_ttl)
+    api.register_routes()
+    return api.app
 
 
 if __name__ == '__main__':
     host = "127.0.0.1"
     port = 5500
     BlockchainAPI_port = 5000
+    profile_blocks = 20
+    profile_cache_size = 10000
+    # Seconds a profile is served from the cache at most, e.g. for a validity check that no new block triggers
+    profile_cache_ttl = 60
 
-    api = NFTMarketplaceAPI(host, port, BlockchainAPI_port)
-    api.run_server()
\ No newline at end of file
+    api = NFTMarketplaceAPI(host, port, BlockchainAPI_port, profile_blocks, profile_cache_size, profile_cache_ttl)
+    api.run_server()
\ No newline at end of file
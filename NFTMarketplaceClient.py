@@ -44,8 +44,11 @@ class NFTMarketplaceClient:
         response = self._send_get_request(endpoint)
         return response["all_collections"]
         
-    def get_profile(self):
+    def get_profile(self, limit=None):
+        # The latest blocks of the profile, limit overrides how many the server sends
         endpoint = f"/get_profile?wallet_address={self.wallet_address}"
+        if limit != None:
+            endpoint += f"&limit={limit}"
         response = self._send_get_request(endpoint)
         return response
     
@@ -412,27 +415,35 @@ class NFTMarketplaceClient:
         try:
             profile = self.get_profile()
 
-            chain = profile['chain']
-            chain = chain[1:]
-            ESG_scores = profile['ESG scores']  # 0: total ESG scores, 1: index 1 ESG scores, ...
+            chain = [block for block in profile['chain'] if block['index'] > 0]
+            ESG_scores = profile['ESG scores']  # 0: total ESG scores, 1: ESG scores of the block at from_index, ...
+            from_index = profile['from_index']
             is_vaild = True if profile['valid'] == 'The chain is VALID' else False
             
+            # Without the model the profile has no scores, the courses and the validity are shown anyway
             horizontal_blockchain_data = []
             for block in chain:
-                i = block['index']
-                formatted_scores = str([float(f"{num:.3f}") for num in ESG_scores[i]])
-                horizontal_blockchain_data.append([block['timestamp'], block['data']['course_title'], block['data']['course_description'], block['data']['transaction_hash'], formatted_scores])
+                row = [block['timestamp'], block['data']['course_title'], block['data']['course_description'], block['data']['transaction_hash']]
+                if ESG_scores != None:
+                    i = block['index'] - from_index + 1
+                    row.append(str([float(f"{num:.3f}") for num in ESG_scores[i]]))
+                horizontal_blockchain_data.append(row)
             
             headers = ['timestamp', 'title', 'description', 'transaction hash', '[E, S, G]']
             data = horizontal_blockchain_data
             max_lenegths = [20, 15, 20, 80, 25]
             truncated_data = [[self.truncate_string(str(data[i][j]), max_lenegths[j]) for j in range(len(data[i]))] for i in range(len(data))]
-            table = tabulate(truncated_data, headers=headers, tablefmt="outline")
+            table = tabulate(truncated_data, headers=headers if ESG_scores != None else headers[:-1], tablefmt="outline")
             print(table)
+            if len(chain) < profile['height'] - 1:
+                print(f"The latest {len(chain)} of {profile['height'] - 1} courses")
             print()
 
-            formatted_scores = [float(f"{num:.3f}") for num in ESG_scores[0]]
-            print(f"Total ESG scores: \033[34m{formatted_scores[0]}, {formatted_scores[1]}, {formatted_scores[2]}\033[0m")
+            if ESG_scores != None:
+                formatted_scores = [float(f"{num:.3f}") for num in ESG_scores[0]]
+                print(f"Total ESG scores: \033[34m{formatted_scores[0]}, {formatted_scores[1]}, {formatted_scores[2]}\033[0m")
+            else:
+                print(f"Total ESG scores: \033[93mNOT AVAILABLE\033[0m (model: {profile.get('model')})")
             print()
 
             if is_vaild:
@@ -495,4 +506,4 @@ if __name__ == '__main__':
         option = input("Enter option: ")
         print()
         if not client.handle_option(option):
-            continue
\ No newline at end of file
+            continue
\ No newline at end of file